@@ -1,4 +1,7 @@
 import os
+import sys
+import netrc
+import argparse
 from getpass import getpass
 import platform
 import shutil
@@ -7,10 +10,159 @@ import requests
 import xarray as xr
 import pandas as pd
 import re
-import math
+from urllib.parse import quote, unquote, parse_qsl, urlencode
+import json
+import time
+import signal
+import cProfile
+import contextlib
+import calendar
 import numpy as np
 import pvlib
-from concurrent.futures import ThreadPoolExecutor
+import queue
+import importlib.util
+from collections import OrderedDict
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+### 0. Run statistics ###
+# Wall time, bytes, throughput and peak memory of every stage (download, read, epw, tmy, pipeline, update)
+# and of every file, kept for stats_summary() and appended as JSON lines to STATS_FILE.
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+STATS_FILE = None        # e.g. '2_Weather_File/stats.jsonl', None = keep the records in memory only
+PROFILE = None           # Profile every stage: None, 'cprofile' (thread of the stage) or 'py-spy' (all threads and processes)
+PROFILE_FOLDER = '2_Weather_File/Profiles/'
+_stats = []
+_stats_lock = threading.Lock()
+_stage_local = threading.local()
+_profiling = False
+
+# Peak resident memory in MB of this process, or of its largest finished child process (e.g. the process pools),
+# None where the resource module is unavailable (Windows)
+def peak_rss_mb(children=False):
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 / 1024 if platform.system() == "Darwin" else peak / 1024
+
+# Add a record: kind 'stage', 'file' (one downloaded, ingested or written file) or 'block' (one time block of read_NC4_3)
+def record_stat(kind, stage, **values):
+    record = dict(kind=kind, stage=stage, time=time.strftime('%Y-%m-%dT%H:%M:%S'), **values)
+    with _stats_lock:
+        _stats.append(record)
+        if STATS_FILE is not None:
+            os.makedirs(os.path.dirname(STATS_FILE) or '.', exist_ok=True)
+            with open(STATS_FILE, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+    return record
+
+# Add counts (files, cells, sites, ...) to the innermost stage running in this thread
+def stage_counts(**values):
+    stack = getattr(_stage_local, 'stack', [])
+    if stack:
+        stack[-1].update(values)
+
+# Start profiling a stage unless a profile is already running, returns the function that stops it and returns the file
+def _start_profile(name, profile):
+    global _profiling
+    with _stats_lock:
+        if profile is None or _profiling:
+            return lambda: None
+        _profiling = True
+
+    def release():
+        global _profiling
+        with _stats_lock:
+            _profiling = False
+
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    path = os.path.join(PROFILE_FOLDER, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}")
+    if profile == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def stop():
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+            release()
+            return path + '.prof'
+    elif profile == 'py-spy':
+        if shutil.which('py-spy') is None:
+            print("py-spy is not installed (pip install py-spy), the stage is not profiled")
+            release()
+            return lambda: None
+        # Samples this process and its pool workers until interrupted, then writes the flame graph
+        process = Popen(['py-spy', 'record', '--subprocesses', '--output', path + '.svg', '--pid', str(os.getpid())])
+
+        def stop():
+            process.send_signal(signal.SIGINT)
+            process.wait()
+            release()
+            return path + '.svg'
+    else:
+        release()
+        raise ValueError(f"Unknown profiler {profile}, use 'cprofile' or 'py-spy'.")
+    return stop
+
+# Time a stage, as a with block or a function decorator. The stage record holds the wall time, the counts given with
+# stage_counts, the files and bytes of the file records of the stage (or of tag), the rates per second and the peak RSS.
+@contextlib.contextmanager
+def stage(name, tag=None, profile=None):
+    values = {}
+    with _stats_lock:
+        first = len(_stats)
+    _stage_local.stack = getattr(_stage_local, 'stack', []) + [values]
+    stop_profile = _start_profile(name, PROFILE if profile is None else profile)
+    start = time.perf_counter()
+    try:
+        yield values
+    finally:
+        seconds = time.perf_counter() - start
+        profile_path = stop_profile()
+        _stage_local.stack = _stage_local.stack[:-1]
+        with _stats_lock:
+            files = [record for record in _stats[first:] if record['kind'] == 'file' and record['stage'] == (tag or name)]
+        values.setdefault('files', len(files))
+        values.setdefault('bytes', sum(record.get('bytes', 0) for record in files))
+        rates = {f'{key}_per_s': values[key] / seconds for key in ('files', 'cells', 'sites') if key in values}
+        rates['MB_per_s'] = values['bytes'] / 1e6 / seconds
+        record_stat('stage', name, seconds=seconds, **values, **rates, peak_rss_mb=peak_rss_mb(),
+                    peak_rss_children_mb=peak_rss_mb(children=True), profile=profile_path)
+
+# Print the stage records and the per-file times of each stage as tables. records: list of records, path of a
+# JSON lines file written by STATS_FILE, or None for the records of this run.
+def stats_summary(records=None):
+    if isinstance(records, str):
+        with open(records, 'r') as file:
+            records = [json.loads(line) for line in file if line.strip()]
+    records = _stats if records is None else records
+
+    print(f"{'stage':<10} {'seconds':>9} {'MB':>9} {'MB/s':>7} {'files':>7} {'files/s':>8} {'cells/s':>8} {'sites/s':>8} {'RSS MB':>8} {'pool MB':>8}")
+    for record in records:
+        if record['kind'] != 'stage':
+            continue
+        rate = lambda key: f"{record[key]:.2f}" if key in record else '-'
+        print(f"{record['stage']:<10} {record['seconds']:>9.1f} {record['bytes'] / 1e6:>9.1f} {record['MB_per_s']:>7.2f} "
+              f"{record['files']:>7} {rate('files_per_s'):>8} {rate('cells_per_s'):>8} {rate('sites_per_s'):>8} "
+              f"{record['peak_rss_mb'] or 0:>8.0f} {record['peak_rss_children_mb'] or 0:>8.0f}")
+
+    files = {}
+    for record in records:
+        if record['kind'] in ('file', 'block') and 'seconds' in record:
+            files.setdefault((record['stage'], record['kind']), []).append(record)
+    if files:
+        print(f"\n{'stage':<10} {'kind':<6} {'count':>7} {'mean s':>8} {'max s':>8}  slowest")
+        for (stage_name, kind), group in files.items():
+            seconds = np.array([record['seconds'] for record in group])
+            slowest = group[int(seconds.argmax())]
+            print(f"{stage_name:<10} {kind:<6} {len(group):>7} {seconds.mean():>8.2f} {seconds.max():>8.2f}  {slowest['name']}")
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 ### 1.Get authorization files for downloading MERRA-2 Data ###
@@ -18,22 +170,30 @@ from concurrent.futures import ThreadPoolExecutor
 # https://lb.gesdisc.eosdis.nasa.gov/meditor/notebookviewer/?notebookUrl=https://github.com/nasa/gesdisc-tutorials/blob/main/notebooks/How_to_Generate_Earthdata_Prerequisite_Files.ipynb
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-def get_authorize_1():
+def get_authorize_1(username=None, password=None):
+
+    # username, password: NASA Earthdata login, asked for when not given. An existing ~/.netrc entry for
+    #                     urs.earthdata.nasa.gov is reused, other entries of ~/.netrc are kept.
+
     homeDir = os.path.expanduser("~") + os.sep
 
-    # Create .urs_cookies and .dodsrc files
-    with open(homeDir + '.urs_cookies', 'w') as file:
-        file.write('')
-        file.close()
-    with open(homeDir + '.dodsrc', 'w') as file:
-        file.write('HTTP.COOKIEJAR={}.urs_cookies\n'.format(homeDir))
-        file.write('HTTP.NETRC={}.netrc'.format(homeDir))
-        file.close()
+    # Create .urs_cookies and .dodsrc files (kept when they exist, so running jobs do not lose their cookies)
+    if not os.path.exists(homeDir + '.urs_cookies'):
+        with open(homeDir + '.urs_cookies', 'w') as file:
+            file.write('')
+    dodsrc = 'HTTP.COOKIEJAR={}.urs_cookies\nHTTP.NETRC={}.netrc'.format(homeDir, homeDir)
+    current = None
+    if os.path.exists(homeDir + '.dodsrc'):
+        with open(homeDir + '.dodsrc', 'r') as file:
+            current = file.read()
+    if current != dodsrc:
+        with open(homeDir + '.dodsrc', 'w') as file:
+            file.write(dodsrc)
 
     print('Saved .urs_cookies and .dodsrc to:', homeDir)
 
     # Copy dodsrc to working directory in Windows
-    if platform.system() == "Windows":  
+    if platform.system() == "Windows" and not os.path.exists(os.path.join(os.getcwd(), '.dodsrc')):
         shutil.copy2(homeDir + '.dodsrc', os.getcwd())
         print('Copied .dodsrc to:', os.getcwd())
 
@@ -41,9 +201,20 @@ def get_authorize_1():
     prompts = ['Enter NASA Earthdata Login Username \n(or create an account at urs.earthdata.nasa.gov): ',
             'Enter NASA Earthdata Login Password: ']
 
-    with open(homeDir + '.netrc', 'w') as file:
-        file.write('machine {} login {} password {}'.format(urs, getpass(prompt=prompts[0]), getpass(prompt=prompts[1])))
-        file.close()
+    netrc_path = homeDir + '.netrc'
+    if os.path.exists(netrc_path):
+        try:
+            if netrc.netrc(netrc_path).authenticators(urs) is not None:
+                print('Using the Earthdata login in:', netrc_path)
+                return
+        except (netrc.NetrcParseError, OSError) as e:
+            print(f"Could not read {netrc_path}: {e}")
+
+    username = username or getpass(prompt=prompts[0])
+    password = password or getpass(prompt=prompts[1])
+    with open(netrc_path, 'a') as file:
+        file.write('\nmachine {} login {} password {}\n'.format(urs, username, password))
+    os.chmod(netrc_path, 0o600)
 
     print('Saved .netrc to:', homeDir)
 
@@ -53,14 +224,225 @@ def get_authorize_1():
 # https://disc.gsfc.nasa.gov/datasets?keywords=Merra-2&page=1&temporalResolution=1%20hour
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-# Define the base directory where the ORIGINAL files will be saved
+# Define the base directory where the ORIGINAL files will be saved (created by the first download).
+# All the stages take their folders as arguments too, these are only the defaults.
 base_dir = "2_Weather_File/MERRA-2_Data/"
-if not os.path.exists(base_dir):
-    os.makedirs(base_dir)
 
-def get_data_2():
-    # Set the path to your text file containing URLs
-    wind_file = "2_Weather_File/URL/Wind/subset_M2T1NXSLV_5.12.4_20241016_025913_.txt"
+# Set the path to your text files containing URLs (the "Download Links List" of each collection)
+URL_FILES = {
+    'Wind': "2_Weather_File/URL/Wind/subset_M2T1NXSLV_5.12.4_20241016_025913_.txt",
+    'Solar': "2_Weather_File/URL/Solar/subset_M2T1NXRAD_5.12.4_20241202_175141_.txt",
+    'Snow': "2_Weather_File/URL/Snow/subset_M2T1NXLND_5.12.4_20241202_232409_.txt",
+    'Precipitation': "2_Weather_File/URL/Precipitation/subset_M2T1NXFLX_5.12.4_20241015_052857_.txt",
+}
+
+# Category folders of a download directory
+def data_folders(data_dir=None):
+    data_dir = base_dir if data_dir is None else data_dir
+    if not os.path.exists(data_dir):
+        return []
+    return [os.path.join(data_dir, folder) for folder in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, folder))]
+
+# Concurrent downloads per MERRA-2 collection, each collection has its own pool of connections
+MAX_WORKERS = {'Wind': 8, 'Solar': 8, 'Snow': 5, 'Precipitation': 8}
+
+# Sizes of the completed downloads of a folder, one "filename size" line appended per file
+SIZES_FILE = '.download_sizes'
+
+# MERRA-2 global grid: 361 latitudes from -90° by 0.5° and 576 longitudes from -180° by 0.625°
+MERRA2_LAT0, MERRA2_DLAT, MERRA2_NLAT = -90.0, 0.5, 361
+MERRA2_LON0, MERRA2_DLON, MERRA2_NLON = -180.0, 0.625, 576
+
+# Variables used by make_epw_4 from each collection
+REQUIRED_VARIABLES = {
+    'Wind': ['T2M', 'T2MDEW', 'QV2M', 'PS', 'U2M', 'V2M'],
+    'Solar': ['SWGDN', 'CLDTOT'],
+    'Snow': ['SNODP'],
+    'Precipitation': ['PRECTOT'],
+}
+
+# Index (i, j) of the MERRA-2 cell containing a location
+def merra2_index(latitude, longitude):
+    i = int(round((latitude - MERRA2_LAT0) / MERRA2_DLAT))
+    j = int(round(((longitude - MERRA2_LON0) % 360) / MERRA2_DLON)) % MERRA2_NLON
+    return min(max(i, 0), MERRA2_NLAT - 1), j
+
+# Grid (sorted latitudes and longitudes) spanned by a list of cell indices
+def merra2_grid(cells):
+    return {'lat': sorted({MERRA2_LAT0 + i * MERRA2_DLAT for i, _ in cells}),
+            'lon': sorted({MERRA2_LON0 + j * MERRA2_DLON for _, j in cells})}
+
+# Rewrite a URL of the downloaded links list so it requests only cell (i, j) and the required variables.
+# Both OPeNDAP constraint expressions (?T2M[0:23][250:260][480:490],...) and the BBOX/VARIABLES parameters
+# of the GES DISC subsetter are supported. The cell is added as a #i_j fragment, which is not sent to the server
+# but names the downloaded file.
+def subset_url(url, collection, i, j):
+    base, _, query = url.partition('#')[0].partition('?')
+    variables = REQUIRED_VARIABLES[collection]
+
+    if 'BBOX=' in query:
+        lat = MERRA2_LAT0 + i * MERRA2_DLAT
+        lon = MERRA2_LON0 + j * MERRA2_DLON
+        params = dict(parse_qsl(query))
+        params['BBOX'] = f'{lat - MERRA2_DLAT / 4},{lon - MERRA2_DLON / 4},{lat + MERRA2_DLAT / 4},{lon + MERRA2_DLON / 4}'
+        params['VARIABLES'] = ','.join(variables)
+        query = urlencode(params, safe=',/')
+    else:
+        # Keep the time range of the original request
+        query = unquote(query)
+        match = re.search(r'\btime\[([^\]]+)\]', query) or re.search(r'\w+\[([^\]]+)\]\[[^\]]+\]\[[^\]]+\]', query)
+        hours = match.group(1) if match else '0:23'
+        query = ','.join([f'{var}[{hours}][{i}:{i}][{j}:{j}]' for var in variables] +
+                         [f'lat[{i}:{i}]', f'lon[{j}:{j}]', f'time[{hours}]'])
+        # Brackets percent-encoded as in the links lists, servers such as Tomcat reject them raw
+        query = quote(query, safe=':,')
+    return f'{base}?{query}#i{i}_j{j}'
+
+def _download_filename(url):
+    url, _, cell = url.partition('#')
+    # For different structure of links
+    match = re.search(r'tavg1_2d.{20}', url)
+    filename = match.group(0) if match else os.path.basename(url)
+    # Single-cell downloads are named after their cell, e.g. tavg1_2d_slv_Nx.20230101.i251_j479.nc4
+    if cell:
+        filename = re.sub(r'(\.nc4)?$', f'.{cell}.nc4', filename, count=1)
+    return filename
+
+# Cell of a single-cell download (None for region files)
+def _cell_tag(file_path):
+    match = re.search(r'\.(i\d+_j\d+)\.nc4$', file_path)
+    return match.group(1) if match else None
+
+def _read_sizes(target_dir):
+    sizes = {}
+    sizes_path = os.path.join(target_dir, SIZES_FILE)
+    if os.path.exists(sizes_path):
+        with open(sizes_path, 'r') as file:
+            for line in file:
+                filename, _, size = line.rstrip('\n').rpartition(' ')
+                if filename and size.isdigit():  # Skip a line cut off by an interrupted run
+                    sizes[filename] = int(size)
+    return sizes
+
+def _new_session(max_workers):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# HTTP answers that can succeed on a later attempt; any other 4xx (401, 403, 404, ...) fails at once
+RETRY_STATUS = {408, 429}
+
+# Connection errors, timeouts, cut off responses, 5xx, 408, 429 and the size checks of _download are retried
+def _retryable(e):
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500 or e.response.status_code in RETRY_STATUS
+    if isinstance(e, requests.exceptions.RequestException):
+        return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError))
+    return True
+
+# Stream one URL to <file>.part and rename it to <file> once complete. A partial .part file is resumed with
+# a Range request when the server supports it. Returns the number of bytes received (0 if the file was skipped).
+def _download(session, url, target_dir, sizes, lock, retries, backoff, timeout, on_complete=None, chunk_size=1 << 20):
+    filename = _download_filename(url)
+    file_path = os.path.join(target_dir, filename)
+    part_path = file_path + '.part'
+
+    # Skip files completed by an earlier run that still have the recorded size
+    if filename in sizes and os.path.exists(file_path) and os.path.getsize(file_path) == sizes[filename]:
+        if on_complete is not None:
+            on_complete(file_path)
+        return 0
+
+    received = 0
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            with session.get(url, stream=True, timeout=timeout, headers=headers) as response:
+                if response.status_code == 416 and offset:
+                    # Nothing left after the .part file: it is complete (the run stopped before the rename) when its size
+                    # is the size of the file in Content-Range (bytes */<size>), otherwise it is started again
+                    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                    if total != str(offset):
+                        os.remove(part_path)
+                        raise IOError(f"{part_path} has {offset} bytes, the file has {total or 'an unknown size'}, downloading it again")
+                    size = offset
+                else:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        offset = 0  # The server sent the whole file
+                    with open(part_path, 'ab' if offset else 'wb') as file:
+                        for chunk in response.iter_content(chunk_size):
+                            file.write(chunk)
+                            received += len(chunk)
+
+                    size = os.path.getsize(part_path)
+                    length = response.headers.get('Content-Length')
+                    if length is not None and 'Content-Encoding' not in response.headers and offset + int(length) != size:
+                        raise IOError(f"received {size - offset} of {length} bytes")
+
+            os.replace(part_path, file_path)
+            with lock:
+                with open(os.path.join(target_dir, SIZES_FILE), 'a') as file:
+                    file.write(f'{filename} {size}\n')
+            print(f"File from {url} downloaded and saved as {file_path}")
+            record_stat('file', 'download', name=filename, bytes=received, seconds=time.perf_counter() - start, attempts=attempt + 1)
+            if on_complete is not None:
+                on_complete(file_path)
+            return received
+        except (requests.exceptions.RequestException, OSError) as e:
+            if attempt == retries or not _retryable(e):
+                print(f"Error downloading {url}: {e}")
+                record_stat('error', 'download', name=filename, bytes=received, seconds=time.perf_counter() - start, error=str(e))
+                raise
+            wait = backoff * 2 ** attempt
+            print(f"Error downloading {url}: {e}, retrying in {wait:.0f} s")
+            time.sleep(wait)
+
+def download_files(urls, target_dir, max_workers=8, retries=5, backoff=1.0, timeout=(30, 600), on_complete=None):
+
+    # urls       : URLs to download into target_dir, files already downloaded completely are skipped
+    # max_workers: concurrent downloads, sharing one session (connection pool)
+    # retries    : retries per file, waiting backoff * 2 ** attempt seconds in between
+    # timeout    : (connect, read) timeout of each request in seconds
+    # on_complete: called with the path of every complete file (downloaded or skipped) from the download thread
+
+    os.makedirs(target_dir, exist_ok=True)
+    sizes = _read_sizes(target_dir)
+    lock = threading.Lock()
+    n_bytes = 0
+    failed = []
+
+    with _new_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_download, session, url, target_dir, sizes, lock, retries, backoff, timeout, on_complete): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                n_bytes += future.result()
+            except (requests.exceptions.RequestException, OSError):
+                failed.append(futures[future])
+
+    print(f"Downloaded {n_bytes / 1e6:.1f} MB to {target_dir}, {len(failed)} of {len(urls)} files failed.")
+    return failed
+
+@stage('download')
+def get_data_2(max_workers=None, retries=5, backoff=1.0, timeout=(30, 600), on_complete=None, sites=None, url_files=None,
+               data_dir=None):
+
+    # max_workers: concurrent downloads per collection, e.g. {'Wind': 8, 'Solar': 8, 'Snow': 5, 'Precipitation': 8}
+    # retries, backoff, timeout, on_complete: see download_files
+    # sites      : list of (name, latitude, longitude). Instead of the whole region of the links list, download only
+    #              the MERRA-2 cells of the sites and only the variables in REQUIRED_VARIABLES.
+    # url_files  : links list of each category (None = URL_FILES)
+    # data_dir   : folder of the downloaded files (None = base_dir)
+
+    url_files = URL_FILES if url_files is None else url_files
+    data_dir = base_dir if data_dir is None else data_dir
+
+    # Text file containing the URLs of each collection
+    wind_file = url_files['Wind']
     
      #   Wind data library: MERRA-2 tavg1_2d_slv_Nx
      #   Download Method: Get File Subsets using OPeNDAP
@@ -80,7 +462,7 @@ def get_data_2():
      #   ps       surface_pressure                                     Pa
      #   TQL      total_precipitable_liquid_water(for comparison)      kg/m²
 
-    solar_file = "2_Weather_File/URL/Solar/subset_M2T1NXRAD_5.12.4_20241202_175141_.txt"
+    solar_file = url_files['Solar']
 
      #   Solar data library: MERRA-2 tavg1_2d_rad_Nx
      #   Download Method: Get File Subsets using OPeNDAP
@@ -90,7 +472,7 @@ def get_data_2():
      #   SWGDN    Surface Incoming Shortwave Flux                      W/m²
      #   CLDFRC   Total Cloud Area Fraction                            NaN
 
-    snow_file = "2_Weather_File/URL/Snow/subset_M2T1NXLND_5.12.4_20241202_232409_.txt"
+    snow_file = url_files['Snow']
 
      #   Snow data library: MERRA-2 tavg1_2d_lnd_Nx
      #   Download Method: Get File Subsets using OPeNDAP
@@ -100,7 +482,7 @@ def get_data_2():
      #   SNODP    Snow_depth                                           m
 
 
-    precipitation_file = "2_Weather_File/URL/Precipitation/subset_M2T1NXFLX_5.12.4_20241015_052857_.txt"
+    precipitation_file = url_files['Precipitation']
 
      #   Precipitation data library: MERRA-2 tavg1_2d_flx_Nx
      #   Download Method: Get File Subsets using OPeNDAP
@@ -110,10 +492,10 @@ def get_data_2():
      #   PRECTOT  total_precipitation                                  kg/m²/s
 
     # Create subdirectories for each type of data if they don't exist
-    wind_dir = os.path.join(base_dir, "Wind")
-    solar_dir = os.path.join(base_dir, "Solar")
-    snow_dir = os.path.join(base_dir, "Snow")
-    precipitation_dir = os.path.join(base_dir, "Precipitation")
+    wind_dir = os.path.join(data_dir, "Wind")
+    solar_dir = os.path.join(data_dir, "Solar")
+    snow_dir = os.path.join(data_dir, "Snow")
+    precipitation_dir = os.path.join(data_dir, "Precipitation")
 
     for directory in [wind_dir, solar_dir, snow_dir, precipitation_dir]:
         os.makedirs(directory, exist_ok=True)
@@ -126,97 +508,381 @@ def get_data_2():
         precipitation_file: precipitation_dir
     }
 
-    def download_file(url, target_dir):
-
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-
-            # For different structure of links
-            match = re.search(r'tavg1_2d.{20}', url)
-            filename = match.group(0) if match else os.path.basename(url)
-
-            file_path = os.path.join(target_dir, filename)
-
-            with open(file_path, 'wb') as file:
-                file.write(response.content)
-
-            print(f"File from {url} downloaded and saved as {file_path}")
-        except requests.exceptions.RequestException as e:
-            print(f"Error downloading {url}: {e}")
-
-    # Multi-threaded Download
-    with ThreadPoolExecutor() as general_executor, ThreadPoolExecutor(max_workers=5) as snow_executor:
+    # Download the collections at the same time, each with its own limit of concurrent downloads
+    with ThreadPoolExecutor(max_workers=len(files_to_folders)) as executor:
+        futures = []
         for data_file, target_dir in files_to_folders.items():
             with open(data_file, 'r') as file:
                 urls = file.read().splitlines()[1:]  # Read URL list and skip the first line
 
-            if "Snow" in target_dir:  # Check if the data being downloaded is snow-related
-                print(f"Using limited threads (max_workers=5) for Snow data in {target_dir}")
-                for url in urls:
-                    snow_executor.submit(download_file, url, target_dir)
-            else:
-                print(f"Using default thread pool for data in {target_dir}")
-                for url in urls:
-                    general_executor.submit(download_file, url, target_dir)
+            collection = os.path.basename(target_dir)
+            if sites is not None:
+                cells = sorted({merra2_index(latitude, longitude) for _, latitude, longitude in sites})
+                urls = [subset_url(url, collection, i, j) for url in urls for i, j in cells]
+                print(f"Requesting {len(cells)} cells of {collection} data for {len(sites)} sites")
+            workers = (max_workers or MAX_WORKERS)[collection]
+            print(f"Using {workers} concurrent downloads for {collection} data in {target_dir}")
+            futures.append(executor.submit(download_files, urls, target_dir, workers, retries, backoff, timeout, on_complete))
+        failed = [url for future in futures for url in future.result()]
 
     # Checking files number in each folder
     for folder_name, folder_path in files_to_folders.items():
-        num_files = len(os.listdir(folder_path))
+        num_files = len([f for f in os.listdir(folder_path) if not f.startswith('.') and not f.endswith('.part')])
         print(f"Folder '{folder_path}' contains {num_files} files.")
 
+    if failed:
+        print(f"{len(failed)} files failed, run get_data_2 again to download only the missing files.")
+
+    return failed
+
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 ### 3. Read and process the original data (NC4) ###
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-# Define the directory where the PROCESSED files will be saved
+# Define the directory where the PROCESSED files will be saved (created by read_NC4_3, default of processed_dir)
 base_output_folder = '2_Weather_File/MERRA-2_Data_Processed/'
-if not os.path.exists(base_output_folder):
-    os.makedirs(base_output_folder)
 
-def read_NC4_3(folders):
+# Temporary file next to path, unique per process and thread so that parallel jobs never write the same one
+def _part_path(path):
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+
+# Write a JSON file in one step, a reader in another job never sees it half written
+def _write_json(path, data, indent=None):
+    part_path = _part_path(path)
+    with open(part_path, 'w') as file:
+        json.dump(data, file, indent=indent)
+    os.replace(part_path, path)
+
+# Lock shared by the threads and processes working on path: a lock file created exclusively, removed when done.
+# A lock file older than stale seconds was left by a killed job and is taken over.
+@contextlib.contextmanager
+def _file_lock(path, stale=60):
+    lock_path = path + '.lock'
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale:
+                    os.remove(lock_path)
+            except OSError:
+                pass  # Released in the meantime
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+# Write the CSVs of one latitude row of a time block. row_values maps each variable to a (time, lon) array,
+# so every cell is a column view of it and no long-format table has to be scanned.
+def _write_lat_row(output_folder, times, lat, lons, row_values, append):
+    for j, lon in enumerate(lons):
+        # Data for the current latitude and longitude
+        df_loc = pd.DataFrame({'time': times, 'lat': lat, 'lon': lon})
+        for var, values in row_values.items():
+            df_loc[var] = values[:, j]
+        # Generate a new filename with the current folder name and coordinates
+        filename = f'{output_folder}/lat_{lat}_lon_{lon}.csv'
+        # Save the data to a CSV file, the first block creates the file and later blocks are appended
+        if append:
+            df_loc.to_csv(filename, index=False, header=False, mode='a')
+        else:
+            df_loc.to_csv(filename, index=False)
+
+# Split a (time, lat, lon) block into per-cell CSVs, one latitude row per task when an executor is given
+def write_block_csv(block, output_folder, append=False, executor=None):
+    times = block['time'].values
+    lons = block['lon'].values
+    values = {var: block[var].transpose('time', 'lat', 'lon').values for var in block.data_vars}
+
+    tasks = [(output_folder, times, lat, lons, {var: arr[:, i, :] for var, arr in values.items()}, append)
+             for i, lat in enumerate(block['lat'].values)]
+    if executor is None:
+        for task in tasks:
+            _write_lat_row(*task)
+    else:
+        # Wait for the whole block so that the next block is appended in time order
+        for future in [executor.submit(_write_lat_row, *task) for task in tasks]:
+            future.result()
+
+# Grid manifest written next to the processed data of every category, whatever the output format
+#   <Category>/grid.json           latitudes and longitudes of the cells (ascending)
+# Processed store: one cube per category and year, written as float32 .npy files that can be memory-mapped
+#   <Category>/store.json          variable names and the minute of the hourly time stamps
+#   <Category>/<YYYY>/<VAR>.npy    float32 array (lat, lon, hour of year), NaN where no data has been written
+# The hour axis is the regular hourly MERRA-2 axis, so each cell is one contiguous run of each file.
+GRID_FILE = 'grid.json'
+STORE_FILE = 'store.json'
+EARTH_RADIUS_KM = 6371.0
+
+def _hours_in_year(year):
+    return 8784 if calendar.isleap(year) else 8760
+
+def _write_grid(output_folder, lats, lons):
+    grid = {'lat': [float(lat) for lat in lats], 'lon': [float(lon) for lon in lons]}
+    grid_path = os.path.join(output_folder, GRID_FILE)
+    if os.path.exists(grid_path) and open_grid(output_folder) != grid:
+        raise ValueError(f"{output_folder} holds data on a different grid, remove it first.")
+    _write_json(grid_path, grid)
+    return grid
+
+def open_grid(output_folder):
+    with open(os.path.join(output_folder, GRID_FILE), 'r') as file:
+        return json.load(file)
+
+def _init_store(output_folder, grid, variables, minute):
+    store = {'variables': list(variables), 'minute': int(minute)}
+    store_path = os.path.join(output_folder, STORE_FILE)
+    if os.path.exists(store_path) and open_store(output_folder) != dict(store, **grid):
+        raise ValueError(f"{output_folder} holds a store with different variables, remove it first.")
+    _write_json(store_path, store)
+    return dict(store, **grid)
+
+def open_store(output_folder):
+    with open(os.path.join(output_folder, STORE_FILE), 'r') as file:
+        return dict(json.load(file), **open_grid(output_folder))
+
+# Index of the closest value on a sorted axis, found by binary search. With a period (longitude)
+# the distance wraps around, so 179.9 is next to -180.
+def _nearest_on_axis(axis, value, period=None):
+    axis = np.asarray(axis)
+    if period is not None:
+        value = axis[0] + (value - axis[0]) % period
+    k = np.searchsorted(axis, value)
+    candidates = np.unique(np.clip([k - 1, k, 0, len(axis) - 1], 0, len(axis) - 1))
+    distance = np.abs(axis[candidates] - value)
+    if period is not None:
+        distance = np.minimum(distance, period - distance)
+    return int(candidates[distance.argmin()])
+
+# Closest cell (i, j) of a rectilinear grid. The lat and lon distances are independent on such a grid,
+# so two binary searches give the nearest cell in O(log n) for any cos(lat) scaling.
+def nearest_cell(grid, latitude, longitude):
+    return _nearest_on_axis(grid['lat'], latitude), _nearest_on_axis(grid['lon'], longitude, period=360)
+
+def _great_circle_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+# The k closest cells as [(i, j, distance in km)], searched in the window of cells around the nearest one
+def k_nearest_cells(grid, latitude, longitude, k=4):
+    i, j = nearest_cell(grid, latitude, longitude)
+    n_lat, n_lon = len(grid['lat']), len(grid['lon'])
+    rows = range(max(i - k, 0), min(i + k + 1, n_lat))
+    cols = sorted({(j + dj) % n_lon for dj in range(-k, k + 1)})
+    cells = [(a, b) for a in rows for b in cols]
+    distance = _great_circle_km(latitude, longitude, np.array([grid['lat'][a] for a, _ in cells]),
+                                np.array([grid['lon'][b] for _, b in cells]))
+    order = np.argsort(distance, kind='stable')[:k]
+    return [(cells[n][0], cells[n][1], float(distance[n])) for n in order]
+
+# Inverse distance weights of the k closest cells as [(i, j, weight)], a cell at the site gets all the weight
+def idw_cells(grid, latitude, longitude, k=4, power=2):
+    cells = k_nearest_cells(grid, latitude, longitude, k)
+    if cells[0][2] < 1e-6:
+        return [(cells[0][0], cells[0][1], 1.0)]
+    weights = np.array([distance for _, _, distance in cells]) ** -power
+    weights /= weights.sum()
+    return [(i, j, float(weight)) for (i, j, _), weight in zip(cells, weights)]
+
+def _open_year_cube(output_folder, store, year, var, mode='r'):
+    path = os.path.join(output_folder, str(year), f'{var}.npy')
+    if mode == 'r+' and not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cube = np.lib.format.open_memmap(path, mode='w+', dtype='float32',
+                                         shape=(len(store['lat']), len(store['lon']), _hours_in_year(year)))
+        cube[:] = np.nan
+        return cube
+    return np.load(path, mmap_mode=mode)
+
+def store_years(output_folder):
+    return sorted(int(name) for name in os.listdir(output_folder) if name.isdigit())
+
+# Source files already written to the store, one "filename size mtime_ns" line appended per file
+INGESTED_FILE = 'ingested.txt'
+
+def _file_stamp(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def _read_ingested(output_folder):
+    ingested = {}
+    ingested_path = os.path.join(output_folder, INGESTED_FILE)
+    if os.path.exists(ingested_path):
+        with open(ingested_path, 'r') as file:
+            for line in file:
+                fields = line.rstrip('\n').rsplit(' ', 2)
+                if len(fields) == 3 and fields[1].isdigit() and fields[2].isdigit():  # Skip a cut off line
+                    ingested[fields[0]] = (int(fields[1]), int(fields[2]))
+    return ingested
+
+def _record_ingested(output_folder, file_paths):
+    with open(os.path.join(output_folder, INGESTED_FILE), 'a') as file:
+        for file_path in file_paths:
+            size, mtime = _file_stamp(file_path)
+            file.write(f'{os.path.basename(file_path)} {size} {mtime}\n')
+
+def _as_slice(indices):
+    if np.array_equal(indices, np.arange(indices[0], indices[0] + len(indices))):
+        return slice(int(indices[0]), int(indices[0]) + len(indices))
+    return indices
+
+# Write a (time, lat, lon) block into the store at the hour offsets of its time stamps and at the position of its
+# cells in the store grid (the store may hold more cells than the block, e.g. single-cell downloads of several sites)
+def write_block_store(block, output_folder, store):
+    times = block['time'].values
+    hours = times.astype('datetime64[h]')
+    years = times.astype('datetime64[Y]')
+    offsets = (hours - years.astype('datetime64[h]')).astype(np.int64)
+    years = years.astype(np.int64) + 1970
+
+    rows = np.searchsorted(store['lat'], block['lat'].values)
+    cols = np.searchsorted(store['lon'], block['lon'].values)
+    if not (np.array_equal(np.array(store['lat'])[rows.clip(max=len(store['lat']) - 1)], block['lat'].values) and
+            np.array_equal(np.array(store['lon'])[cols.clip(max=len(store['lon']) - 1)], block['lon'].values)):
+        raise ValueError(f"The cells of the data are not in the grid of {output_folder}.")
+
+    for year in np.unique(years):
+        in_year = years == year
+        # Contiguous cells and hours are written as slices, otherwise with fancy indexing
+        index = (_as_slice(rows), _as_slice(cols), _as_slice(offsets[in_year]))
+        if not all(isinstance(k, slice) for k in index):
+            index = np.ix_(*[np.arange(k.start, k.stop) if isinstance(k, slice) else k for k in index])
+        for var in store['variables']:
+            cube = _open_year_cube(output_folder, store, int(year), var, mode='r+')
+            cube[index] = block[var].transpose('lat', 'lon', 'time').values[:, :, in_year]
+            cube.flush()
+
+# Read the full hourly record of one cell as a DataFrame with a datetime64 'time' column and float32 variables
+def read_cell(output_folder, i, j, years=None, store=None):
+    store = store or open_store(output_folder)
+    years = store_years(output_folder) if years is None else years
+    times = []
+    columns = {var: [] for var in store['variables']}
+    for year in years:
+        times.append(pd.date_range(f'{year}-01-01', periods=_hours_in_year(year), freq='h') + pd.Timedelta(minutes=store['minute']))
+        for var in store['variables']:
+            columns[var].append(np.asarray(_open_year_cube(output_folder, store, year, var)[i, j, :]))
+
+    df = pd.DataFrame({'time': np.concatenate(times) if times else np.array([], dtype='datetime64[ns]'),
+                       'lat': store['lat'][i], 'lon': store['lon'][j]})
+    for var, values in columns.items():
+        df[var] = np.concatenate(values) if values else np.array([], dtype='float32')
+    return df
+
+@stage('read')
+def read_NC4_3(folders=None, streaming=True, time_chunk=744, workers=None, formats=('npy',), incremental=True, processed_dir=None):
+
+    # streaming=True : open the files lazily with dask chunks along time and materialize one time block
+    #                  (time_chunk hours, 744 = one month) at a time, so peak memory does not grow with the number of files.
+    # streaming=False: load every file into memory at once (the original behaviour).
+    # workers        : processes used to write the per-cell CSVs (None = all CPUs, 1 = no process pool).
+    # formats        : 'npy' writes the memory-mapped store read by make_epw_4, 'csv' the lat_X_lon_Y.csv files.
+    # incremental    : only write the files that are not in the store yet (new name, size or modification time).
+    #                  Hours already in the store are overwritten, so each hour is kept once. The CSV files are always rewritten.
+    # processed_dir  : folder of the processed data (None = base_output_folder)
+    # folders        : category folders of the NC4 files (None = the folders in base_dir)
+    # Returns the first and last time written per category, e.g. {'Wind': ('2024-01-01T00:30', '2024-01-31T23:30')}.
+
+    folders = data_folders() if folders is None else folders
+    processed_dir = base_output_folder if processed_dir is None else processed_dir
+    updated = {}
+    counts = {'files': 0, 'bytes': 0, 'cells': 0}
+    workers = workers or os.cpu_count()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and 'csv' in formats else None
 
     for folder_path in folders:
         # Get the category name from the folder path (e.g., 'Precipitation', 'Snow')
         folder_name = os.path.basename(os.path.normpath(folder_path))
 
         # Create an output folder specific to the current data category
-        output_folder = os.path.join(base_output_folder, folder_name)
+        output_folder = os.path.join(processed_dir, folder_name)
         os.makedirs(output_folder, exist_ok=True)
 
         # Get all NC4 file paths in the current folder
-        nc4_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.nc4')]
+        nc4_files = sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.nc4'))
         
         if not nc4_files:
             print(f"No NC4 files found in {folder_path}.")
             continue  # Skip to the next folder if no NC4 files are found
 
-        # Read all NC4 files
-        datasets = [xr.open_dataset(file) for file in nc4_files]
-
-        # Combine all datasets along the time dimension
-        combined_ds = xr.concat(datasets, dim='time')
-
-        # Convert to pandas DataFrame and reset the index
-        df = combined_ds.to_dataframe().reset_index()
-
-        # Extract unique latitude and longitude combinations
-        unique_locs = df[['lat', 'lon']].drop_duplicates()
-
-        # Process each unique latitude and longitude combination
-        for _, loc in unique_locs.iterrows():
-            lat = loc['lat']
-            lon = loc['lon']
-            # Filter data for the current latitude and longitude
-            df_loc = df[(df['lat'] == lat) & (df['lon'] == lon)]
-            # Generate a new filename with the current folder name and coordinates
-            filename = f'{output_folder}/lat_{lat}_lon_{lon}.csv'
-            # Save the filtered data to a CSV file
-            df_loc.to_csv(filename, index=False)
-            print(f"Saved data for lat: {lat}, lon: {lon} to {filename}")
-
-# List of folder paths containing NC4 files
-folder_list = [os.path.join(base_dir, folder) for folder in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, folder))]
+        all_files = nc4_files
+        if incremental and 'csv' not in formats:
+            # Skip the files already in the store
+            ingested = _read_ingested(output_folder)
+            nc4_files = [file for file in nc4_files if ingested.get(os.path.basename(file)) != _file_stamp(file)]
+            if not nc4_files:
+                print(f"No new NC4 files in {folder_path}.")
+                continue
+
+        # Files downloaded for single cells (get_data_2 with sites) are grouped by cell, each group covers a region.
+        # The grid of the category is the union of the regions of all files, not only the new ones.
+        groups = {}
+        for file in nc4_files:
+            groups.setdefault(_cell_tag(file), []).append(file)
+        lats, lons = set(), set()
+        for file in {_cell_tag(file): file for file in all_files}.values():
+            with xr.open_dataset(file) as ds:
+                lats.update(ds['lat'].values.tolist())
+                lons.update(ds['lon'].values.tolist())
+
+        # Grid manifest used for the nearest-cell lookups of make_epw_batch
+        grid = _write_grid(output_folder, sorted(lats), sorted(lons))
+        first, last = None, None
+
+        for group_files in groups.values():
+            if streaming:
+                # Lazily open all NC4 files as one dataset, nothing is read until a block is loaded
+                combined_ds = xr.open_mfdataset(group_files, combine='nested', concat_dim='time', chunks={'time': time_chunk},
+                                                data_vars='minimal', coords='minimal', compat='override')
+            else:
+                # Read all NC4 files and combine them along the time dimension
+                datasets = [xr.open_dataset(file) for file in group_files]
+                combined_ds = xr.concat(datasets, dim='time')
+                time_chunk = combined_ds.sizes['time']
+
+            # Time order, keeping the last file of hours that appear in more than one file
+            combined_ds = combined_ds.drop_duplicates('time', keep='last').sortby('time')
+
+            n_cells = combined_ds.sizes['lat'] * combined_ds.sizes['lon']
+            if 'npy' in formats:
+                minute = pd.Timestamp(combined_ds['time'].values[0]).minute
+                store = _init_store(output_folder, grid, combined_ds.data_vars, minute)
+
+            for start in range(0, combined_ds.sizes['time'], time_chunk):
+                block_start = time.perf_counter()
+                # Materialize only the current time block and split it into the per-cell files
+                block = combined_ds.isel(time=slice(start, start + time_chunk)).load()
+                if 'npy' in formats:
+                    write_block_store(block, output_folder, store)
+                if 'csv' in formats:
+                    write_block_csv(block, output_folder, append=start > 0, executor=executor)
+
+                print(f"Saved hours {start} to {start + block.sizes['time']} of {folder_name} for {n_cells} locations")
+                record_stat('block', 'read', name=f"{folder_name} {str(block['time'].values[0])[:16]}", hours=block.sizes['time'],
+                            cells=n_cells, seconds=time.perf_counter() - block_start)
+
+            times = combined_ds['time'].values
+            first = times[0] if first is None else min(first, times[0])
+            last = times[-1] if last is None else max(last, times[-1])
+            combined_ds.close()
+
+        updated[folder_name] = (str(first.astype('datetime64[m]')), str(last.astype('datetime64[m]')))
+        if 'npy' in formats:
+            _record_ingested(output_folder, nc4_files)
+        counts['files'] += len(nc4_files)
+        counts['bytes'] += sum(os.path.getsize(file) for file in nc4_files)
+        counts['cells'] += len(grid['lat']) * len(grid['lon'])
+        print(f"Saved data for {folder_name} to {output_folder}, peak RSS: {peak_rss_mb()} MB")
+
+    if executor is not None:
+        executor.shutdown()
+
+    stage_counts(**counts)
+    return updated
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 ### 4. Make the EPW file  ###
@@ -224,160 +890,369 @@ folder_list = [os.path.join(base_dir, folder) for folder in os.listdir(base_dir)
 # https://climate.onebuilding.org/papers/EnergyPlus_Weather_File_Format.pdf
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-def make_epw_4():
+def _processed_folders(processed_dir=None):
+    processed_dir = base_output_folder if processed_dir is None else processed_dir
+    return [os.path.join(processed_dir, folder) for folder in os.listdir(processed_dir) if os.path.isdir(os.path.join(processed_dir, folder))]
 
-    latitude = 35.4
-    longitude = 119.3
-    solar_path = os.path.join(base_output_folder, "Solar")
-    
-    # Find the closest latitude and longitude pair
-    def find_closest_file(solar_path, latitude, longitude):
-        files = [f for f in os.listdir(solar_path) if f.endswith('.csv')]
-        
-        pattern = r"lat_([-+]?\d*\.\d+|\d+)_lon_([-+]?\d*\.\d+|\d+)"
-        
-        closest_file = None
-        min_distance = float('inf')
-        
-        for file in files:
-            match = re.search(pattern, file)
-            if match:
-                file_lat = float(match.group(1))
-                file_lon = float(match.group(2))
-                
-                distance = math.sqrt((file_lat - latitude) ** 2 + (file_lon - longitude) ** 2)
-                
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_file = file
-        
-        return closest_file
+# Cells of a site as ((lat, lon), weight) pairs, looked up in the Solar grid like the original single-site code:
+# the closest cell, or with interpolate the inverse distance weighted 4 closest cells
+def _site_cells(solar_grid, latitude, longitude, interpolate=False):
+    if interpolate:
+        cells = idw_cells(solar_grid, latitude, longitude)
+    else:
+        cells = [nearest_cell(solar_grid, latitude, longitude) + (1.0,)]
+    return tuple(((solar_grid['lat'][i], solar_grid['lon'][j]), weight) for i, j, weight in cells)
 
-    # Read CSV
-    processed_folder_list = [os.path.join(base_output_folder, folder) for folder in os.listdir(base_output_folder) if os.path.isdir(os.path.join(base_output_folder, folder))]
-
-    df_precipitation = None
-    df_snow = None
-    df_solar = None
-    df_wind = None
-
-    # Lat and lon you prefer
-    target_filename = find_closest_file(solar_path, latitude, longitude)
+# Read the data of one cell for every category, from the store only the UTC years around the local years
+def _load_cell(processed_folder_list, cell, store_format, years=None):
+    lat, lon = cell
+    data = {}
 
     # Iterate through each folder and read the files
     for folder in processed_folder_list:
-        file_path = os.path.join(folder, target_filename)
+        if store_format == 'npy':
+            file_path = os.path.join(folder, STORE_FILE)
+        else:
+            file_path = os.path.join(folder, f'lat_{lat}_lon_{lon}.csv')
         
         # Check if the file exists
-        if os.path.exists(file_path):
-            # Store data in different df based on different folder names
-            if 'Precipitation' in folder:
-                df_precipitation = pd.read_csv(file_path)
-                print(f"Loaded Precipitation data from {file_path}")
-            elif 'Snow' in folder:
-                df_snow = pd.read_csv(file_path)
-                print(f"Loaded Snow data from {file_path}")
-            elif 'Solar' in folder:
-                df_solar = pd.read_csv(file_path)
-                print(f"Loaded Solar data from {file_path}")
-            elif 'Wind' in folder:
-                df_wind = pd.read_csv(file_path)
-                print(f"Loaded Wind data from {file_path}")
-        else:
+        if not os.path.exists(file_path):
             print(f"File not found: {file_path}")
+            continue
+
+        if store_format == 'npy':
+            # Map only the requested cell of the store
+            store = open_store(folder)
+            i, j = nearest_cell(store, lat, lon)
+            # The link lists of the categories are separate requests, their regions can differ: the cell must be in
+            # this store too (within half a grid step), not only its nearest neighbour
+            if abs(store['lat'][i] - lat) >= MERRA2_DLAT / 2 or abs((store['lon'][j] - lon + 180) % 360 - 180) >= MERRA2_DLON / 2:
+                print(f"File not found: {folder} has no data at lat: {lat}, lon: {lon}")
+                continue
+            utc_years = None if years is None else [year for year in store_years(folder) if min(years) - 1 <= year <= max(years) + 1]
+            df = read_cell(folder, i, j, years=utc_years, store=store)
+            file_path = f"{folder} (lat: {store['lat'][i]}, lon: {store['lon'][j]})"
+        else:
+            df = pd.read_csv(file_path, parse_dates=['time'])
+
+        # Store data under the category name of the folder
+        for category in ['Precipitation', 'Snow', 'Solar', 'Wind']:
+            if category in folder:
+                data[category] = df
+                print(f"Loaded {category} data from {file_path}")
 
     # Check for successful reads
     print("##DataFrames loaded successfully:##")
-    print("Precipitation DataFrame:", df_precipitation is not None)
-    print("Snow DataFrame:", df_snow is not None)
-    print("Solar DataFrame:", df_solar is not None)
-    print("Wind DataFrame:", df_wind is not None)
-    
+    for category in ['Precipitation', 'Snow', 'Solar', 'Wind']:
+        print(f"{category} DataFrame:", category in data)
+
+    return data
+
+# Solar position cache. The (true) zenith used by DISC depends only on the location and the time, so it is
+# computed once per cell, UTC year and pvlib method, then kept in memory (LRU) and on disk (.npz files).
+SOLAR_CACHE_FOLDER = '2_Weather_File/Solar_Cache/'
+SOLAR_CACHE_ENTRIES = 256     # Cell-years kept in memory per process
+SOLAR_CACHE_MB = 1024         # Size of the disk cache, the least recently used files are deleted above it
+_solar_cache = OrderedDict()
+_solar_cache_lock = threading.Lock()
+_solar_cache_written = 0      # Bytes this process wrote to the disk cache since its last eviction
+
+# 'auto' uses pvlib's numba compiled SPA when numba is installed
+def _solar_method(method):
+    if method != 'auto':
+        return method
+    return 'nrel_numba' if importlib.util.find_spec('numba') is not None else 'nrel_numpy'
+
+# Delete the least recently used files above SOLAR_CACHE_MB. The folder is only scanned after this process has written
+# 1/16 of the limit, so the cache can grow that much past it. Other processes (pool workers, parallel jobs) evict at
+# the same time, a file they removed first is skipped.
+def _evict_solar_cache(written):
+    global _solar_cache_written
+    limit = SOLAR_CACHE_MB * 1024 * 1024
+    with _solar_cache_lock:
+        _solar_cache_written += written
+        if _solar_cache_written < limit / 16:
+            return
+        _solar_cache_written = 0
+
+    files = []
+    for entry in os.scandir(SOLAR_CACHE_FOLDER):
+        if entry.name.endswith('.npz'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    for _, size, path in files:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# Zenith and day of year of every hour of one UTC year at a cell (hours start at the given minute)
+def solar_geometry(lat, lon, year, minute=30, method='auto'):
+    method = _solar_method(method)
+    key = (float(lat), float(lon), int(year), int(minute), method)
+    with _solar_cache_lock:
+        if key in _solar_cache:
+            _solar_cache.move_to_end(key)
+            return _solar_cache[key]
+
+    path = os.path.join(SOLAR_CACHE_FOLDER, 'lat_{}_lon_{}_{}_{}_{}.npz'.format(*key))
+    geometry = None
+    try:
+        with np.load(path) as cached:
+            geometry = cached['zenith'], cached['day_of_year']
+        os.utime(path)  # Mark as recently used for the disk eviction
+    except FileNotFoundError:
+        pass  # Not cached yet, or evicted by another process
+    if geometry is None:
+        times = pd.date_range(f'{year}-01-01', periods=_hours_in_year(year), freq='h', tz='UTC') + pd.Timedelta(minutes=minute)
+        solar_position = pvlib.solarposition.get_solarposition(time=times, latitude=lat, longitude=lon, method=method)
+        geometry = solar_position['zenith'].to_numpy(), times.dayofyear.to_numpy().astype('int16')
+        os.makedirs(SOLAR_CACHE_FOLDER, exist_ok=True)
+        part_path = _part_path(path)
+        with open(part_path, 'wb') as file:
+            np.savez(file, zenith=geometry[0], day_of_year=geometry[1])
+        size = os.path.getsize(part_path)
+        os.replace(part_path, path)
+        _evict_solar_cache(size)
+
+    with _solar_cache_lock:
+        _solar_cache[key] = geometry
+        while len(_solar_cache) > SOLAR_CACHE_ENTRIES:
+            _solar_cache.popitem(last=False)
+    return geometry
+
+# Zenith and day of year at the given UTC times (naive, on the hourly axis) from the cached cell-years
+def _cached_solar_geometry(lat, lon, times, method='auto'):
+    times = pd.DatetimeIndex(times)
+    zenith = np.full(len(times), np.nan)
+    day_of_year = np.zeros(len(times), dtype='int16')
+    hours = times.to_numpy().astype('datetime64[h]')
+    years = times.year.to_numpy()
+    for year in np.unique(years):
+        in_year = years == year
+        offsets = (hours[in_year] - np.datetime64(f'{year}-01-01', 'h')).astype(np.int64)
+        year_zenith, year_day_of_year = solar_geometry(lat, lon, year, times[in_year][0].minute, method)
+        zenith[in_year] = year_zenith[offsets]
+        day_of_year[in_year] = year_day_of_year[offsets]
+    return zenith, day_of_year
+
+# Analysis period: local years of the EPW files and the time zone of the sites, as an IANA name or the UTC offset in
+# hours (e.g. 8 or -5). Change them here or pass years and timezone to make_epw_batch.
+EPW_YEARS = [2023]
+EPW_TIMEZONE = 'Asia/Shanghai'
+
+# UTC offset of the standard time of a time zone in whole hours (EPW files are in local standard time, without daylight saving)
+def _utc_offset(timezone, year):
+    if isinstance(timezone, str):
+        new_year = pd.Timestamp(f'{year}-01-01', tz=timezone)
+        seconds = (new_year.utcoffset() - new_year.dst()).total_seconds()
+    else:
+        seconds = timezone * 3600
+    if seconds % 3600:
+        raise ValueError(f"The UTC offset of {timezone} is not a whole number of hours, the hourly MERRA-2 data cannot be aligned to it.")
+    return int(seconds // 3600)
+
+# Hours of the local years as integer hours since 1970-01-01 00:00, on the UTC axis and in local standard time.
+# Leap years have 8784 hours, with leap_day=False the 24 hours of February 29 are left out.
+def _epw_hours(years, timezone, leap_day=True):
+    utc_hours, local_hours = [], []
+    for year in years:
+        local = np.arange(_hours_in_year(year)) + np.datetime64(f'{year}-01-01', 'h').astype(np.int64)
+        if not leap_day and calendar.isleap(year):
+            local = np.delete(local, np.s_[59 * 24:60 * 24])
+        local_hours.append(local)
+        utc_hours.append(local - _utc_offset(timezone, year))
+    return np.concatenate(utc_hours), np.concatenate(local_hours)
+
+# Row of each hour in the data (time stamps on the hourly axis), -1 where the hour is missing. The rows are placed by
+# their integer hour offset, so no time stamps are compared; of repeated hours the last row is used.
+def _hour_positions(times, hours):
+    first = hours.min()
+    lookup = np.full(hours.max() - first + 1, -1, dtype=np.int64)
+    offsets = np.asarray(times).astype('datetime64[h]').astype(np.int64) - first
+    in_range = (offsets >= 0) & (offsets < len(lookup))
+    lookup[offsets[in_range]] = np.flatnonzero(in_range)
+    return lookup[hours - first]
+
+# Factor applied to the MERRA-2 radiation (GHI, DNI and DHI) in the EPW files, or pass scaling_factor to make_epw_batch
+SCALING_FACTOR = 0.8985
+
+# EPW files made so far, one entry per file with its site, its years and the UTC period it covers, used by run_update
+EPW_MANIFEST = 'epw_manifest.json'
+
+def _read_epw_manifest(output_folder):
+    manifest_path = os.path.join(output_folder, EPW_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+# Name of the EPW file of a site for the years of period: <site>_<year> for the files of one year each, else <site>
+def _epw_name(name, period, per_year):
+    return f'{name}_{period[0]}' if per_year else name
+
+# Jobs writing to the same output folder add their files one at a time under the lock of the manifest
+def _record_epws(output_folder, sites, periods, per_year, store_format, interpolate, timezone, combined, leap_day, scaling_factor=None):
+    minute = np.timedelta64(30, 'm')
+    files = {}
+    for period in periods:
+        utc_hours, _ = _epw_hours(period, timezone, leap_day)
+        utc_period = {'start': str(utc_hours.min().astype('datetime64[h]').astype('datetime64[m]') + minute),
+                      'end': str(utc_hours.max().astype('datetime64[h]').astype('datetime64[m]') + minute)}
+        for name, latitude, longitude in sites:
+            files[_epw_name(name, period, per_year)] = dict(utc_period, site=name, latitude=latitude, longitude=longitude,
+                                                            store_format=store_format, interpolate=interpolate, years=list(period),
+                                                            timezone=timezone, combined=combined, leap_day=leap_day,
+                                                            per_year=per_year, scaling_factor=scaling_factor)
+    manifest_path = os.path.join(output_folder, EPW_MANIFEST)
+    with _file_lock(manifest_path):
+        manifest = _read_epw_manifest(output_folder)
+        manifest.update(files)
+        _write_json(manifest_path, manifest, indent=1)
+
+# Derive the hourly EPW table of one site for the local years from the data of its cell.
+# Returns the table and the number of hours missing in the data (written as EPW missing values).
+def _epw_table(data, latitude, longitude, solar_cache=True, solar_method='auto', years=None, timezone=None, leap_day=True,
+               scaling_factor=None):
+    utc_hours, local_hours = _epw_hours(EPW_YEARS if years is None else years, EPW_TIMEZONE if timezone is None else timezone, leap_day)
+
+    # Variables of every category at the hours of the EPW, NaN where the hour is missing in the data
+    values = {}
+    missing = np.zeros(len(utc_hours), dtype=bool)
+    for category, df in data.items():
+        positions = _hour_positions(df['time'].to_numpy(), utc_hours)
+        missing |= positions < 0
+        values[category] = {}
+        for var in df.columns.drop(['time', 'lat', 'lon']):
+            column = df[var].to_numpy()
+            values[category][var] = np.concatenate([column, np.full(1, np.nan, column.dtype)])[positions]  # -1 -> NaN
+            missing |= np.isnan(values[category][var])  # Hours the store has not received are NaN
+    precipitation, snow, solar, wind = (values[category] for category in ['Precipitation', 'Snow', 'Solar', 'Wind'])
+
     # Calculate DNI, DHI from GHI
-    df_solar['pd_time'] = pd.to_datetime(df_solar['time'])
-    solar_position = pvlib.solarposition.get_solarposition(time=df_solar['pd_time'], latitude=latitude, longitude=longitude, pressure=df_wind['PS'], temperature=(df_wind['T2M']-273.15))
-    df_solar['solar_zenith'] = solar_position['zenith'].values
-    df_solar['day_of_year'] = df_solar['pd_time'].dt.dayofyear
-    dni= pvlib.irradiance.disc(ghi=df_solar['SWGDN'].values, solar_zenith=df_solar['solar_zenith'].values, datetime_or_doy=df_solar['day_of_year'], pressure=df_wind['PS'].values)
-    df_solar['DNI'] = dni['dni']
-    df_solar['DHI'] = df_solar['SWGDN'] - df_solar['DNI'] * np.cos(np.radians(df_solar['solar_zenith']))
-    scaleing_factor = 0.8985
+    times = data['Solar']['time']
+    minute = pd.Timestamp(times.iloc[0]).minute if len(times) else 30
+    utc_times = pd.DatetimeIndex((utc_hours * 60 + minute).astype('datetime64[m]'))
+    if solar_cache:
+        # Solar position at the cell centre, shared by all sites of the cell and cached per year
+        solar_zenith, day_of_year = _cached_solar_geometry(data['Solar']['lat'].iloc[0], data['Solar']['lon'].iloc[0], utc_times, solar_method)
+    else:
+        solar_position = pvlib.solarposition.get_solarposition(time=utc_times, latitude=latitude, longitude=longitude, pressure=wind['PS'], temperature=(wind['T2M']-273.15), method=_solar_method(solar_method))
+        solar_zenith = solar_position['zenith'].values
+        day_of_year = utc_times.dayofyear
+    dni = pvlib.irradiance.disc(ghi=solar['SWGDN'], solar_zenith=solar_zenith, datetime_or_doy=day_of_year, pressure=wind['PS'])
+    # disc returns 0 at low sun even without GHI, keep the missing hours missing
+    solar['DNI'] = np.where(np.isnan(solar['SWGDN']), np.nan, np.asarray(dni['dni']))
+    solar['DHI'] = solar['SWGDN'] - solar['DNI'] * np.cos(np.radians(solar_zenith))
+    scaleing_factor = SCALING_FACTOR if scaling_factor is None else scaling_factor
 
     # Calculate relative humidity
-    df_wind['e'] = (df_wind['QV2M'] * df_wind['PS']) / ( 0.622 + df_wind['QV2M'])
-    df_wind['e_s'] = 6.112 * np.exp((17.67 *( df_wind['T2M']- 273.15)) / (df_wind['T2M'] - 273.15 + 243.5)) * 100
-    df_wind['Relative Humidity'] = (df_wind['e'] / df_wind['e_s']) * 100  
-    df_wind['Relative Humidity'] = df_wind['Relative Humidity'].clip(upper=110)
+    wind['e'] = (wind['QV2M'] * wind['PS']) / ( 0.622 + wind['QV2M'])
+    wind['e_s'] = 6.112 * np.exp((17.67 *( wind['T2M']- 273.15)) / (wind['T2M'] - 273.15 + 243.5)) * 100
+    wind['Relative Humidity'] = (wind['e'] / wind['e_s']) * 100
+    wind['Relative Humidity'] = wind['Relative Humidity'].clip(max=110)
 
     # Calculate wind spead and direction
-    df_wind['wind_speed'] = np.sqrt(df_wind['U2M']**2 + df_wind['V2M']**2)
-    df_wind['wind_direction'] = np.degrees(np.arctan2(df_wind['U2M'], df_wind['V2M']))
-    df_wind['wind_direction'] = (df_wind['wind_direction'] + 360) % 360
-    
-    # Analysis period (reset time zone from UTC to your research area)
-    date_range = pd.date_range(start='2023-01-01 00:30:00', end='2023-12-31 23:30:00', freq='H', tz='Asia/Shanghai')
-
-    def process_data(df):
-        # Time zone, from UTC to China time
-        df['time'] = pd.to_datetime(df['time']).dt.tz_localize('UTC')
-        df['time'] = df['time'].dt.tz_convert('Asia/Shanghai')
-        
-        df_filtered = df[df['time'].isin(date_range)]
-        return df_filtered
+    wind['wind_speed'] = np.sqrt(wind['U2M']**2 + wind['V2M']**2)
+    wind['wind_direction'] = np.degrees(np.arctan2(wind['U2M'], wind['V2M']))
+    wind['wind_direction'] = (wind['wind_direction'] + 360) % 360
 
-    df_wind_filtered = process_data(df_wind)
-    df_solar_filtered = process_data(df_solar)
-    df_snow_filtered = process_data(df_snow)
-    df_precipitation_filtered = process_data(df_precipitation)
+    # Local date and hour of every row, from the integer hours
+    local = local_hours.astype('datetime64[h]')
+    year_start, month_start, day_start = (local.astype(unit) for unit in ('datetime64[Y]', 'datetime64[M]', 'datetime64[D]'))
 
+    # Constant fields are kept as scalars and broadcast by _write_epw
     epw_data = {
-        'Year': date_range.year,
-        'Month': date_range.month,
-        'Day': date_range.day,
-        'Hour': date_range.hour + 1,  # The time in EnergyPlus starts from 1.
-        'Minute': [30] * len(date_range),
-        'Data Source and Uncertainty Flags': ['?9?9?9?9E0?9?9?9?9*9?9?9?9?9?9?9?9?9*9*9?9*9'] * len(date_range),
-        'Dry Bulb Temperature': df_wind_filtered['T2M'] - 273.15,
-        'Dew Point Temperature': df_wind_filtered['T2MDEW'] - 273.15,
-        'Relative Humidity': df_wind_filtered['Relative Humidity'],
-        'Atmospheric Station Pressure': df_wind_filtered['PS'],
-        'Extraterrestrial Horizontal Radiation': [9999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Extraterrestrial Direct Normal Radiation': [9999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Horizontal Infrared Radiation Intensity': [9999] * len(date_range), # Automaticly calculate from Dry Bulb Temperature, Dew Point Temperature and Opaque Sky Cover.
-        'Global Horizontal Radiation': df_solar_filtered['SWGDN'] * scaleing_factor,
-        'Direct Normal Radiation': df_solar_filtered['DNI'] * scaleing_factor,
-        'Diffuse Horizontal Radiation': df_solar_filtered['DHI'] * scaleing_factor,
-        'Global Horizontal Illuminance': [999999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Direct Normal Illuminance': [999999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Diffuse Horizontal Illuminance': [999999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Zenith Luminance': [9999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Wind Direction': df_wind_filtered['wind_direction'],
-        'Wind Speed': df_wind_filtered['wind_speed'],
-        'Total Sky Cover': (df_solar_filtered['CLDTOT'] * 10).round(),
-        'Opaque Sky Cover': (df_solar_filtered['CLDTOT'] * 10).round(),
-        'Visibility': [9999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Ceiling Height': [99999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Present Weather Observation': [9] * len(date_range), # It is not currently used in EnergyPlus.
-        'Present Weather Codes': [999999999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Precipitable Water': [999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Aerosol Optical Depth': [0.999] * len(date_range), # It is not currently used in EnergyPlus.
-        'Snow Depth': df_snow_filtered['SNODP'] * 100,  # m to cm
-        'Days Since Last Snowfall': [99] * len(date_range), # It is not currently used in EnergyPlus.
-        'Albedo': [0.99] * len(date_range), # It is not currently used in EnergyPlus.
-        'Liquid Precipitation Depth': df_precipitation_filtered['PRECTOT'] * 3600,
-        'Liquid Precipitation Quantity': [0] * len(date_range) # It is not currently used in EnergyPlus.
+        'Year': year_start.astype(np.int64) + 1970,
+        'Month': (month_start - year_start.astype('datetime64[M]')).astype(np.int64) + 1,
+        'Day': (day_start - month_start.astype('datetime64[D]')).astype(np.int64) + 1,
+        'Hour': (local - day_start).astype(np.int64) + 1,  # The time in EnergyPlus starts from 1.
+        'Minute': 30,
+        'Data Source and Uncertainty Flags': '?9?9?9?9E0?9?9?9?9*9?9?9?9?9?9?9?9?9*9*9?9*9',
+        'Dry Bulb Temperature': wind['T2M'] - 273.15,
+        'Dew Point Temperature': wind['T2MDEW'] - 273.15,
+        'Relative Humidity': wind['Relative Humidity'],
+        'Atmospheric Station Pressure': wind['PS'],
+        'Extraterrestrial Horizontal Radiation': 9999, # It is not currently used in EnergyPlus.
+        'Extraterrestrial Direct Normal Radiation': 9999, # It is not currently used in EnergyPlus.
+        'Horizontal Infrared Radiation Intensity': 9999, # Automaticly calculate from Dry Bulb Temperature, Dew Point Temperature and Opaque Sky Cover.
+        'Global Horizontal Radiation': solar['SWGDN'] * scaleing_factor,
+        'Direct Normal Radiation': solar['DNI'] * scaleing_factor,
+        'Diffuse Horizontal Radiation': solar['DHI'] * scaleing_factor,
+        'Global Horizontal Illuminance': 999999, # It is not currently used in EnergyPlus.
+        'Direct Normal Illuminance': 999999, # It is not currently used in EnergyPlus.
+        'Diffuse Horizontal Illuminance': 999999, # It is not currently used in EnergyPlus.
+        'Zenith Luminance': 9999, # It is not currently used in EnergyPlus.
+        'Wind Direction': wind['wind_direction'],
+        'Wind Speed': wind['wind_speed'],
+        'Total Sky Cover': solar['CLDTOT'] * 10,
+        'Opaque Sky Cover': solar['CLDTOT'] * 10,
+        'Visibility': 9999, # It is not currently used in EnergyPlus.
+        'Ceiling Height': 99999, # It is not currently used in EnergyPlus.
+        'Present Weather Observation': 9, # It is not currently used in EnergyPlus.
+        'Present Weather Codes': 999999999, # It is not currently used in EnergyPlus.
+        'Precipitable Water': 999, # It is not currently used in EnergyPlus.
+        'Aerosol Optical Depth': 0.999, # It is not currently used in EnergyPlus.
+        'Snow Depth': snow['SNODP'] * 100,  # m to cm
+        'Days Since Last Snowfall': 99, # It is not currently used in EnergyPlus.
+        'Albedo': 0.99, # It is not currently used in EnergyPlus.
+        'Liquid Precipitation Depth': precipitation['PRECTOT'] * 3600,
+        'Liquid Precipitation Quantity': 0 # It is not currently used in EnergyPlus.
     }
 
-    df_epw = pd.DataFrame(epw_data)
-
-    # Path to the intermediate file, which will be deleted after the execution of Merra_to_EPW_2.py
-    output_folder = '2_Weather_File/EPW/'
-    os.makedirs(output_folder, exist_ok=True)
-    df_epw.to_csv('2_Weather_File/EPW/hourly_data_2023.csv', index=False) 
-
-    # EPW file header ()
-    # The Header only records the main information of the weather data and is not involved in the calculation. Here the Header of Qingdao, China is used.
-    text = """LOCATION,Qingdao.Intl.AP,SD,CHN,SRC-TMYx,548570,35.5,119.375,8.0,10.1
+    return epw_data, int(missing.sum())
+
+# EPW data fields in file order: (name, decimals, value written when missing), decimals None for text
+EPW_FIELDS = [
+    ('Year', 0, None),
+    ('Month', 0, None),
+    ('Day', 0, None),
+    ('Hour', 0, None),
+    ('Minute', 0, None),
+    ('Data Source and Uncertainty Flags', None, None),
+    ('Dry Bulb Temperature', 1, 99.9),
+    ('Dew Point Temperature', 1, 99.9),
+    ('Relative Humidity', 0, 999),
+    ('Atmospheric Station Pressure', 0, 999999),
+    ('Extraterrestrial Horizontal Radiation', 0, 9999),
+    ('Extraterrestrial Direct Normal Radiation', 0, 9999),
+    ('Horizontal Infrared Radiation Intensity', 0, 9999),
+    ('Global Horizontal Radiation', 0, 9999),
+    ('Direct Normal Radiation', 0, 9999),
+    ('Diffuse Horizontal Radiation', 0, 9999),
+    ('Global Horizontal Illuminance', 0, 999999),
+    ('Direct Normal Illuminance', 0, 999999),
+    ('Diffuse Horizontal Illuminance', 0, 999999),
+    ('Zenith Luminance', 0, 9999),
+    ('Wind Direction', 0, 999),
+    ('Wind Speed', 1, 999),
+    ('Total Sky Cover', 0, 99),
+    ('Opaque Sky Cover', 0, 99),
+    ('Visibility', 0, 9999),
+    ('Ceiling Height', 0, 99999),
+    ('Present Weather Observation', 0, 9),
+    ('Present Weather Codes', 0, 999999999),
+    ('Precipitable Water', 0, 999),
+    ('Aerosol Optical Depth', 3, 0.999),
+    ('Snow Depth', 0, 999),
+    ('Days Since Last Snowfall', 0, 99),
+    ('Albedo', 2, 999),
+    ('Liquid Precipitation Depth', 1, 999),
+    ('Liquid Precipitation Quantity', 1, 99),
+]
+
+# EPW file header ()
+# The Header only records the main information of the weather data and is not involved in the calculation. Here the Header of Qingdao, China is used.
+# The LOCATION line is written for each site by _epw_header, EnergyPlus takes the latitude, longitude and time zone from it.
+EPW_HEADER = """LOCATION,Qingdao.Intl.AP,SD,CHN,SRC-TMYx,548570,35.5,119.375,8.0,10.1
 DESIGN CONDITIONS,1,2021 ASHRAE Handbook -- Fundamentals - Chapter 14 Climatic Design Information,,Heating,1,-8.8,-6.9,-18.9,0.7,-1.4,-16.9,0.9,-0.9,11.4,-2.6,10.4,-2.2,2.7,340,0.487,Cooling,8,7.3,33.1,24.3,31.8,23.8,30.2,23.5,27.1,30.0,26.5,29.1,25.9,28.2,4.4,180,26.3,21.9,28.7,25.9,21.4,28.4,25.1,20.4,27.6,87.0,30.0,83.9,29.2,80.9,28.7,30.1,Extremes,10.2,9.0,7.9,-11.8,35.9,1.9,1.8,-13.1,37.2,-14.2,38.3,-15.2,39.3,-16.6,40.6
 TYPICAL/EXTREME PERIODS,6,Summer - Week Nearest Max Temperature For Period,Extreme,7/27,8/ 2,Summer - Week Nearest Average Temperature For Period,Typical,6/29,7/ 5,Winter - Week Nearest Min Temperature For Period,Extreme,1/ 6,1/12,Winter - Week Nearest Average Temperature For Period,Typical,1/13,1/19,Autumn - Week Nearest Average Temperature For Period,Typical,10/20,10/26,Spring - Week Nearest Average Temperature For Period,Typical,4/12,4/18
 GROUND TEMPERATURES,3,.5,,,,2.96,1.88,3.79,6.78,14.60,20.64,24.71,25.95,23.83,19.15,12.89,7.08,2,,,,6.92,5.00,5.39,6.98,12.21,16.94,20.73,22.76,22.33,19.67,15.36,10.78,4,,,,10.20,8.23,7.80,8.40,11.36,14.55,17.47,19.50,19.98,18.83,16.29,13.20
@@ -386,36 +1261,654 @@ COMMENTS 1,""
 COMMENTS 2,""
 DATA PERIODS,1,1,Data,Sunday,1/ 1,12/31"""
 
-    with open('df_epwheader.txt', 'w') as f:
-        f.write(text)
-
-    with open('df_epwheader.txt', 'r') as f:
-        epwheader_content = f.read()
+# Header for the years of an EPW file: LOCATION of the site, leap year flag and first weekday and dates of the data period.
+# site is (name, latitude, longitude); the WMO number and the elevation of a MERRA-2 site are unknown (999999 and 0.0).
+def _epw_header(years, timezone, leap_day=True, site=None):
+    lines = EPW_HEADER.split('\n')
+    location = lines[0].split(',')
+    if site is not None:
+        name, latitude, longitude = site
+        location[1:8] = [str(name).replace(',', ' '), '-', '-', 'MERRA-2', '999999', str(round(float(latitude), 4)),
+                         str(round(float(longitude), 4))]
+        location[9] = '0.0'
+        lines[6] = 'COMMENTS 2,"MERRA-2 data, WMO station number and elevation unknown"'
+    location[8] = f'{_utc_offset(timezone, years[0]):.1f}'
+    lines[0] = ','.join(location)
+    leap_year = leap_day and any(calendar.isleap(year) for year in years)
+    lines[4] = f"HOLIDAYS/DAYLIGHT SAVINGS,{'Yes' if leap_year else 'No'},0,0,0"
+    period = '1/ 1,12/31' if len(years) == 1 else f'1/ 1/{years[0]},12/31/{years[-1]}'
+    lines[7] = f'DATA PERIODS,1,1,Data,{calendar.day_name[calendar.weekday(years[0], 1, 1)]},{period}'
+    return '\n'.join(lines)
+
+# Write the header and the hourly data to the EPW file in one pass. Constant fields are formatted once into
+# the row format, the other fields are rounded to their EPW precision (NaN -> missing value) and written by one np.savetxt.
+def _write_epw(epw_data, epw_path, header=EPW_HEADER):
+    row_format = []
+    columns = []
+    for name, decimals, missing in EPW_FIELDS:
+        value = epw_data[name]
+        if np.ndim(value) == 0:
+            row_format.append(str(value) if decimals is None else f'{value:.{decimals}f}')
+        else:
+            value = np.asarray(value, dtype='float64')
+            if missing is not None:
+                value = np.where(np.isnan(value), missing, value)
+            columns.append(np.round(value, decimals) + 0.0)  # + 0.0 turns -0.0 into 0.0
+            row_format.append(f'%.{decimals}f')
+
+    # Write to a temporary file next to the EPW, so a reader never sees a half written file
+    part_path = _part_path(epw_path)
+    with open(part_path, 'w') as f:
+        f.write(header + '\n')
+        np.savetxt(f, np.column_stack(columns), fmt=','.join(row_format))
+    os.replace(part_path, epw_path)
+
+# Inverse distance weighted mean of the variables of several cells, category by category
+def _blend(datas, weights):
+    data = {}
+    for category, df in datas[0].items():
+        df = df.copy()
+        variables = [column for column in df.columns if column not in ('time', 'lat', 'lon')]
+        df[variables] = sum(weight * cell_data[category][variables].to_numpy() for cell_data, weight in zip(datas, weights))
+        data[category] = df
+    return data
+
+# Group the sites by their cells, so each cell is read only once. 'all' is one site per cell named lat_X_lon_Y.
+def _group_sites(sites, interpolate=False, processed_dir=None):
+    # Read the grid manifest once for all sites
+    solar_grid = open_grid(os.path.join(base_output_folder if processed_dir is None else processed_dir, "Solar"))
+
+    if sites == 'all':
+        sites = [(f'lat_{lat}_lon_{lon}', lat, lon) for lat in solar_grid['lat'] for lon in solar_grid['lon']]
+
+    sites_by_cell = {}
+    for name, latitude, longitude in sites:
+        cells = _site_cells(solar_grid, latitude, longitude, interpolate)
+        sites_by_cell.setdefault(cells, []).append((name, latitude, longitude))
+    return sites, sites_by_cell
+
+# Data of a site's cells, blended when there are several
+def _cells_data(processed_folder_list, cells, store_format, years=None):
+    datas = [_load_cell(processed_folder_list, cell, store_format, years) for cell, _ in cells]
+    return datas[0] if len(cells) == 1 else _blend(datas, [weight for _, weight in cells])
+
+# Module settings the worker processes of make_epw_batch and make_tmy_batch use. Workers that are spawned (Windows,
+# macOS) import the module again, so the settings of the parent (e.g. --solar-cache-dir) are handed to _init_worker.
+WORKER_SETTINGS = ['SOLAR_CACHE_FOLDER', 'SOLAR_CACHE_ENTRIES', 'SOLAR_CACHE_MB', 'SCALING_FACTOR', 'STATS_FILE', 'PROFILE', 'PROFILE_FOLDER']
+
+def _worker_settings():
+    return {name: globals()[name] for name in WORKER_SETTINGS}
+
+def _init_worker(settings):
+    globals().update(settings)
+
+# Build the EPW files of all sites that share the same cells (runs in a worker process for make_epw_batch).
+# Returns the file records for the run statistics, the worker processes do not share them.
+def _make_cell_epws(processed_folder_list, cells, store_format, sites, output_folder, solar_cache, solar_method,
+                    years, timezone, periods, per_year, leap_day, scaling_factor):
+    start = time.perf_counter()
+    data = _cells_data(processed_folder_list, cells, store_format, years)
+    records = [('block', dict(name=f'cells {[cell for cell, _ in cells]}', seconds=time.perf_counter() - start))]
+    for name, latitude, longitude in sites:
+        for period in periods:
+            start = time.perf_counter()
+            epw_name = _epw_name(name, period, per_year)
+            epw_path = os.path.join(output_folder, f'{epw_name}.epw')
+            epw_data, missing = _epw_table(data, latitude, longitude, solar_cache, solar_method, period, timezone, leap_day,
+                                           scaling_factor)
+            _write_epw(epw_data, epw_path, _epw_header(period, timezone, leap_day, (name, latitude, longitude)))
+            if missing:
+                print(f"{missing} of {len(epw_data['Year'])} hours of {epw_name} are not in the data, written as missing values")
+            print(f"Saved EPW for {epw_name} (lat: {latitude}, lon: {longitude}) to {epw_path}")
+            records.append(('file', dict(name=epw_name, bytes=os.path.getsize(epw_path), seconds=time.perf_counter() - start,
+                                         missing_hours=missing)))
+    return records
+
+@stage('epw')
+def make_epw_batch(sites='all', store_format='npy', workers=None, output_folder='2_Weather_File/EPW/', interpolate=False,
+                   solar_cache=True, solar_method='auto', years=None, timezone=None, combined=False, leap_day=True,
+                   processed_dir=None, scaling_factor=None, per_year=None):
+
+    # sites       : list of (name, latitude, longitude), or 'all' for one EPW per MERRA-2 cell named lat_X_lon_Y
+    # store_format: 'npy' reads the cells from the memory-mapped store, 'csv' from the lat_X_lon_Y.csv files
+    # workers     : processes used to build the EPW files (None = all CPUs, 1 = no process pool)
+    # interpolate : blend the 4 closest cells by inverse distance weighting instead of taking the closest cell
+    # solar_cache : take the solar position at the cell centre from the cache (see solar_geometry),
+    #               False computes it at every site
+    # solar_method: pvlib solar position method, 'auto' = 'nrel_numba' if numba is installed else 'nrel_numpy'
+    # years       : local years of the EPW files (None = EPW_YEARS), e.g. range(1981, 2021)
+    # timezone    : time zone of the sites (None = EPW_TIMEZONE), an IANA name or the UTC offset in whole hours
+    # combined    : one multi-year EPW per site instead of one EPW per site and year (<name>_<year>.epw)
+    # leap_day    : keep February 29 of leap years (8784 hours), False drops it so every year has 8760 hours
+    # processed_dir : folder of the processed data (None = base_output_folder)
+    # scaling_factor: factor of the radiation (None = SCALING_FACTOR)
+    # per_year      : name the files of one year <name>_<year>.epw (None = when there are several years and not combined)
+
+    start = time.perf_counter()
+    os.makedirs(output_folder, exist_ok=True)
+    years = sorted(int(year) for year in (EPW_YEARS if years is None else years))
+    timezone = EPW_TIMEZONE if timezone is None else timezone
+    # One file per year named <site>_<year>, or one file for all years named <site>
+    periods = [years] if combined else [[year] for year in years]
+    per_year = not combined and (len(years) > 1 if per_year is None else per_year)
+
+    processed_folder_list = _processed_folders(processed_dir)
+    sites, sites_by_cell = _group_sites(sites, interpolate, processed_dir)
+    tasks = [(processed_folder_list, cells, store_format, cell_sites, output_folder, solar_cache, solar_method,
+              years, timezone, periods, per_year, leap_day, scaling_factor) for cells, cell_sites in sites_by_cell.items()]
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(_worker_settings(),)) as executor:
+            records = [record for cell_records in executor.map(_make_cell_epws, *zip(*tasks)) for record in cell_records]
+    else:
+        records = [record for task in tasks for record in _make_cell_epws(*task)]
+    _record_epws(output_folder, sites, periods, per_year, store_format, interpolate, timezone, combined, leap_day, scaling_factor)
+    for kind, values in records:
+        record_stat(kind, 'epw', **values)
+    n_files = sum(kind == 'file' for kind, _ in records)
+    stage_counts(sites=len(sites), cells=len(tasks))
+
+    seconds = time.perf_counter() - start
+    print(f"Generated {n_files} EPW files for {len(sites)} sites from {len(tasks)} cells in {seconds:.1f} s ({len(sites) / seconds:.2f} sites/s)")
+
+def make_epw_4(store_format='npy', **options):
+
+    # store_format: 'npy' reads the cell from the memory-mapped store, 'csv' from the lat_X_lon_Y.csv files
+    # options     : further options of make_epw_batch, e.g. years, timezone, output_folder, processed_dir
 
-    df_epw.to_csv('epw.txt', index=False, header=False)  
+    # Lat and lon you prefer
+    latitude = 35.4
+    longitude = 119.3
 
-    with open('epw.txt', 'r') as f:
-        df_epw_content = f.read()
+    make_epw_batch([('EPW_from_Merra2', latitude, longitude)], store_format=store_format, workers=1, **options)
+
+
+
+# Typical meteorological year (TMY) from the multi-year store. For each calendar month the candidate years are compared
+# with the long-term distribution of daily values by the Finkelstein-Schafer (FS) statistic, and the most typical month is
+# taken from its year. The statistics are computed on (sites, years, days) arrays, so all candidate years of a group of
+# cells are compared at once.
+#   'sandia': TMY2/TMY3 selection. The 5 months with the lowest weighted sum of FS statistics are ranked by the closeness of
+#             their mean and median to the long-term ones, then persistence (runs of warm, cool and dull days) is checked.
+#   'iso'   : ISO 15927-4 selection. The years are ranked by the FS statistics of temperature, humidity and radiation,
+#             and of the 3 best the month with the mean wind speed closest to the long-term mean is taken.
+MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+# Daily indices of the FS statistics: (EPW field, daily statistic, Sandia weight)
+TMY_INDICES = {
+    'sandia': [('Dry Bulb Temperature', 'max', 1 / 20), ('Dry Bulb Temperature', 'min', 1 / 20), ('Dry Bulb Temperature', 'mean', 2 / 20),
+               ('Dew Point Temperature', 'max', 1 / 20), ('Dew Point Temperature', 'min', 1 / 20), ('Dew Point Temperature', 'mean', 2 / 20),
+               ('Wind Speed', 'max', 1 / 20), ('Wind Speed', 'mean', 1 / 20),
+               ('Global Horizontal Radiation', 'sum', 5 / 20), ('Direct Normal Radiation', 'sum', 5 / 20)],
+    'iso': [('Dry Bulb Temperature', 'mean', None), ('Relative Humidity', 'mean', None), ('Global Horizontal Radiation', 'sum', None)],
+}
+
+# Fields smoothed across the month boundaries, over this many hours on each side
+TMY_SMOOTH_FIELDS = ['Dry Bulb Temperature', 'Dew Point Temperature', 'Relative Humidity', 'Atmospheric Station Pressure', 'Wind Speed']
+TMY_SMOOTH_HOURS = {'sandia': 6, 'iso': 8}
+
+# Fraction of the values along the last axis that are <= each value (empirical CDF at the values), NaN ignored
+def _cdf(values):
+    finite = np.isfinite(values)
+    values = np.where(finite, values, np.inf)
+    order = np.argsort(values, axis=-1, kind='stable')
+    ordered = np.take_along_axis(values, order, axis=-1)
+    # Count of values <= each sorted value: the position after the last of its equal values
+    n = ordered.shape[-1]
+    last = np.concatenate([ordered[..., 1:] != ordered[..., :-1], np.ones(ordered.shape[:-1] + (1,), dtype=bool)], axis=-1)
+    counts = np.minimum.accumulate(np.where(last, np.arange(1, n + 1), n)[..., ::-1], axis=-1)[..., ::-1]
+    np.put_along_axis(counts, order, counts.copy(), axis=-1)
+    return np.where(finite, counts / np.maximum(finite.sum(axis=-1, keepdims=True), 1), np.nan)
+
+# FS statistic of every year of a month: mean distance between the CDF of the year and the long-term CDF at the daily values.
+# days is (sites, years, days of the month); years with missing days get inf.
+def _fs_statistic(days):
+    n_sites, n_years, n_days = days.shape
+    long_term = _cdf(days.reshape(n_sites, n_years * n_days)).reshape(days.shape)
+    missing = np.isnan(days)
+    fs = np.where(missing, 0, np.abs(_cdf(days) - long_term)).sum(axis=-1) / n_days
+    return np.where(missing.any(axis=-1), np.inf, fs)
+
+# Longest run and number of runs of consecutive True days along the last axis
+def _runs(flags):
+    day = np.arange(flags.shape[-1])
+    run_length = day - np.maximum.accumulate(np.where(flags, -1, day), axis=-1)
+    starts = flags & ~np.concatenate([np.zeros(flags.shape[:-1] + (1,), dtype=bool), flags[..., :-1]], axis=-1)
+    return run_length.max(axis=-1), starts.sum(axis=-1)
+
+# Index of the selected year of every month, (sites, 12), from the daily values {(field, statistic): (sites, years, 365)}
+def tmy_months(daily, method='sandia'):
+    any_daily = next(iter(daily.values()))
+    n_sites = any_daily.shape[0]
+    selected = np.zeros((n_sites, 12), dtype=np.int64)
+    sites = np.arange(n_sites)[:, None]
+    month_starts = np.concatenate([[0], np.cumsum(MONTH_DAYS)])
+
+    for month in range(12):
+        month_days = {key: values[:, :, month_starts[month]:month_starts[month + 1]] for key, values in daily.items()}
+        fs = {key: _fs_statistic(days) for key, days in month_days.items()}
+        complete = np.isfinite(sum(fs.values()))
+
+        if method == 'sandia':
+            weighted = sum(weight * fs[(field, statistic)] for field, statistic, weight in TMY_INDICES['sandia'])
+            candidates = np.argsort(weighted, axis=-1, kind='stable')[:, :5]
+
+            # Closeness of the mean and median of the daily mean temperature and daily radiation to the long-term ones,
+            # in long-term standard deviations
+            closeness = 0
+            flags = []
+            for key in [('Dry Bulb Temperature', 'mean'), ('Global Horizontal Radiation', 'sum')]:
+                days = month_days[key]
+                pooled = days.reshape(n_sites, -1)
+                spread = np.nanstd(pooled, axis=-1, keepdims=True)
+                spread = np.where(spread > 0, spread, 1)
+                candidate_days = days[sites, candidates]
+                closeness = closeness + (np.abs(np.nanmean(candidate_days, axis=-1) - np.nanmean(pooled, axis=-1, keepdims=True)) +
+                                         np.abs(np.nanmedian(candidate_days, axis=-1) - np.nanmedian(pooled, axis=-1, keepdims=True))) / spread
+                low, high = np.nanpercentile(pooled, [33, 67], axis=-1)
+                flags.append(candidate_days < low[:, None, None])
+                if key[0] == 'Dry Bulb Temperature':
+                    flags.append(candidate_days > high[:, None, None])
+
+            # Persistence: a candidate with the longest run or the most runs of cool, warm or dull days is left out
+            excluded = np.zeros(candidates.shape, dtype=bool)
+            for condition in flags:
+                longest, n_runs = _runs(condition)
+                excluded |= (longest == longest.max(axis=-1, keepdims=True)) & (longest > 0)
+                excluded |= (n_runs == n_runs.max(axis=-1, keepdims=True)) & (n_runs > 0)
+
+            # The closest complete candidate that passes, or the closest complete one when all are left out
+            order = np.argsort(closeness, axis=-1, kind='stable')
+            by_closeness = np.take_along_axis(candidates, order, axis=-1)
+            incomplete = ~np.take_along_axis(complete, by_closeness, axis=-1)
+            excluded = np.take_along_axis(excluded, order, axis=-1) | incomplete
+            first = np.where(excluded.all(axis=-1), np.argmin(incomplete, axis=-1), np.argmin(excluded, axis=-1))
+            selected[:, month] = by_closeness[np.arange(n_sites), first]
+        else:
+            # Sum of the ranks of the years by each FS statistic, then of the 3 best the mean wind speed closest to the long-term
+            ranks = sum(np.argsort(np.argsort(fs[(field, statistic)], axis=-1, kind='stable'), axis=-1)
+                        for field, statistic, _ in TMY_INDICES['iso'])
+            candidates = np.argsort(np.where(complete, ranks, np.iinfo(np.int64).max), axis=-1, kind='stable')[:, :3]
+            wind = month_days[('Wind Speed', 'mean')]
+            deviation = np.abs(np.nanmean(wind, axis=-1) - np.nanmean(wind.reshape(n_sites, -1), axis=-1, keepdims=True))
+            deviation = np.where(complete, deviation, np.inf)
+            best = np.argmin(np.take_along_axis(deviation, candidates, axis=-1), axis=-1)
+            selected[:, month] = candidates[np.arange(n_sites), best]
+
+        if not complete.any(axis=-1).all():
+            print(f"No complete year of month {month + 1} for {(~complete.any(axis=-1)).sum()} sites, its hours are missing values")
+    return selected
+
+# Daily statistic of an hourly (..., 8760) field
+def _daily(hourly, statistic):
+    days = hourly.reshape(hourly.shape[:-1] + (365, 24))
+    return {'max': np.max, 'min': np.min, 'mean': np.mean, 'sum': np.sum}[statistic](days, axis=-1)
+
+# Assemble the TMY of one site from its (years, 8760) table: each month from its selected year, and the smoothed fields
+# cross-faded between the years of two adjacent months over the hours around the boundary (January follows December)
+def _tmy_table(table, years, selected, smooth_hours):
+    hour_starts = np.concatenate([[0], np.cumsum(MONTH_DAYS)]) * 24
+    month_of_hour = np.repeat(np.arange(12), MONTH_DAYS * 24)
+    year_of_hour = selected[month_of_hour]
+    hours = np.arange(8760)
+
+    tmy = {}
+    for name, value in table.items():
+        if np.ndim(value) == 0:
+            tmy[name] = value
+            continue
+        tmy[name] = value[year_of_hour, hours]
+        if name in TMY_SMOOTH_FIELDS and smooth_hours:
+            for month in range(12):
+                window = (hour_starts[month] + np.arange(-smooth_hours, smooth_hours)) % 8760
+                before, after = selected[month - 1], selected[month]
+                weight = (np.arange(2 * smooth_hours) + 0.5) / (2 * smooth_hours)
+                tmy[name][window] = (1 - weight) * value[before, window] + weight * value[after, window]
+    tmy['Year'] = np.asarray(years)[year_of_hour]
+    return tmy
+
+# Build the TMY files of a group of cells (runs in a worker process for make_tmy_batch), returns the records as _make_cell_epws
+def _make_cell_tmys(processed_folder_list, cell_groups, store_format, output_folder, solar_cache, solar_method, years, timezone,
+                    method, smooth_hours, scaling_factor):
+    # Tables of every candidate year of every site, without February 29 so each year has 8760 hours
+    sites, tables = [], []
+    records = []
+    for cells, cell_sites in cell_groups:
+        start = time.perf_counter()
+        data = _cells_data(processed_folder_list, cells, store_format, years)
+        for name, latitude, longitude in cell_sites:
+            table, _ = _epw_table(data, latitude, longitude, solar_cache, solar_method, years, timezone, leap_day=False,
+                                  scaling_factor=scaling_factor)
+            tables.append({key: value if np.ndim(value) == 0 else np.asarray(value, dtype='float64').reshape(len(years), 8760)
+                           for key, value in table.items()})
+            sites.append((name, latitude, longitude))
+        records.append(('block', dict(name=f'cells {[cell for cell, _ in cells]}', seconds=time.perf_counter() - start)))
+
+    # Daily indices of all sites and years as (sites, years, 365) arrays
+    keys = {(field, statistic) for field, statistic, _ in TMY_INDICES[method]} | {('Dry Bulb Temperature', 'mean'),
+            ('Global Horizontal Radiation', 'sum'), ('Wind Speed', 'mean')}
+    daily = {(field, statistic): _daily(np.stack([table[field] for table in tables]), statistic) for field, statistic in keys}
+    start = time.perf_counter()
+    selected = tmy_months(daily, method)
+    records.append(('block', dict(name=f'select {len(sites)} sites', seconds=time.perf_counter() - start)))
+
+    for (name, latitude, longitude), table, site_selected in zip(sites, tables, selected):
+        start = time.perf_counter()
+        epw_path = os.path.join(output_folder, f'{name}_TMY.epw')
+        header = _epw_header([years[site_selected[0]]], timezone, False, (name, latitude, longitude)).split('\n')
+        months = '; '.join(f'{calendar.month_abbr[month + 1]} {years[year]}' for month, year in enumerate(site_selected))
+        header[5] = f'COMMENTS 1,"TMY ({method}) from MERRA-2 {years[0]}-{years[-1]}: {months}"'
+        _write_epw(_tmy_table(table, years, site_selected, smooth_hours), epw_path, '\n'.join(header))
+        print(f"Saved TMY for {name} (lat: {latitude}, lon: {longitude}) to {epw_path}: {months}")
+        records.append(('file', dict(name=f'{name}_TMY', bytes=os.path.getsize(epw_path), seconds=time.perf_counter() - start)))
+    return records
+
+@stage('tmy')
+def make_tmy_batch(sites='all', years=None, store_format='npy', workers=None, output_folder='2_Weather_File/EPW/', interpolate=False,
+                   solar_cache=True, solar_method='auto', timezone=None, method='sandia', smooth_hours=None, chunk=8,
+                   processed_dir=None, scaling_factor=None):
+
+    # sites       : list of (name, latitude, longitude), or 'all' for one TMY per MERRA-2 cell; saved as <name>_TMY.epw
+    # years       : candidate years, e.g. range(1991, 2021) (None = EPW_YEARS)
+    # method      : 'sandia' (TMY2/TMY3) or 'iso' (ISO 15927-4)
+    # smooth_hours: hours smoothed on each side of the month boundaries (None = 6 for 'sandia', 8 for 'iso', 0 = none)
+    # chunk       : cells compared at once in one process; memory grows with chunk * years
+    # store_format, workers, interpolate, solar_cache, solar_method, timezone, processed_dir, scaling_factor: see make_epw_batch
+
+    start = time.perf_counter()
+    if method not in TMY_INDICES:
+        raise ValueError(f"Unknown TMY method {method}, use 'sandia' or 'iso'.")
+    os.makedirs(output_folder, exist_ok=True)
+    years = sorted(int(year) for year in (EPW_YEARS if years is None else years))
+    timezone = EPW_TIMEZONE if timezone is None else timezone
+    smooth_hours = TMY_SMOOTH_HOURS[method] if smooth_hours is None else smooth_hours
+
+    processed_folder_list = _processed_folders(processed_dir)
+    sites, sites_by_cell = _group_sites(sites, interpolate, processed_dir)
+    cell_groups = list(sites_by_cell.items())
+    tasks = [(processed_folder_list, cell_groups[k:k + chunk], store_format, output_folder, solar_cache, solar_method, years,
+              timezone, method, smooth_hours, scaling_factor) for k in range(0, len(cell_groups), chunk)]
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(_worker_settings(),)) as executor:
+            records = [record for chunk_records in executor.map(_make_cell_tmys, *zip(*tasks)) for record in chunk_records]
+    else:
+        records = [record for task in tasks for record in _make_cell_tmys(*task)]
+    for kind, values in records:
+        record_stat(kind, 'tmy', **values)
+    n_sites = sum(kind == 'file' for kind, _ in records)
+    stage_counts(sites=len(sites), cells=len(cell_groups))
+
+    seconds = time.perf_counter() - start
+    print(f"Generated {n_sites} TMY files from {len(years)} years of {len(cell_groups)} cells in {seconds:.1f} s ({n_sites / seconds:.2f} sites/s)")
 
-    combined_content = epwheader_content + '\n' + df_epw_content
 
-    with open('2_Weather_File/EPW/EPW_from_Merra2.epw', 'w') as f:
-        f.write(combined_content)
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+### 5. Pipeline: download, process and make the EPW files at the same time ###
+# Every .nc4 file is written to the processed store as soon as it has been downloaded,
+# so the total time is close to the longer of downloading and processing instead of their sum.
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-    delete_list = ['epw.txt', 'df_epwheader.txt']
-    for delete in delete_list:
-        if os.path.exists(delete):
-            os.remove(delete)
-            print(f"{delete} has been deleted")
-        else:
-            print(f"{delete} not exist")
+# Write the files of one category to its store in arrival order, until None is received.
+# Each file is written at the offset of its own hours, so the order of the downloads does not matter.
+def _ingest_worker(file_queue, output_folder, ingested, failed, grid=None):
+    store = None
+    done = _read_ingested(output_folder) if os.path.exists(output_folder) else {}
+    while True:
+        file_path = file_queue.get()
+        if file_path is None:
+            break
+        if done.get(os.path.basename(file_path)) == _file_stamp(file_path):
+            continue  # Already in the store
+        try:
+            start = time.perf_counter()
+            with xr.open_dataset(file_path) as ds:
+                block = ds.load()
+            if store is None:
+                os.makedirs(output_folder, exist_ok=True)
+                # Single-cell downloads are written into the grid of all sites, region files bring their own grid
+                if grid is None:
+                    grid = {'lat': block['lat'].values, 'lon': block['lon'].values}
+                grid = _write_grid(output_folder, grid['lat'], grid['lon'])
+                minute = pd.Timestamp(block['time'].values[0]).minute
+                store = _init_store(output_folder, grid, block.data_vars, minute)
+            write_block_store(block, output_folder, store)
+            _record_ingested(output_folder, [file_path])
+            ingested.append(file_path)
+            record_stat('file', 'ingest', name=os.path.basename(file_path), bytes=os.path.getsize(file_path),
+                        seconds=time.perf_counter() - start, queued=file_queue.qsize())
+        except Exception as e:  # Keep consuming, a stopped consumer would block the downloads
+            print(f"Error processing {file_path}: {e}")
+            failed.append(file_path)
+
+@stage('pipeline', tag='ingest')
+def run_pipeline(sites=None, queue_size=16, max_workers=None, retries=5, backoff=1.0, timeout=(30, 600), workers=None,
+                 subset=False, url_files=None, data_dir=None, processed_dir=None, output_folder='2_Weather_File/EPW/', years=None,
+                 timezone=None, scaling_factor=None):
+
+    # sites     : sites passed to make_epw_batch once all hours are in the store (None = no EPW files)
+    # subset    : download only the cells of the sites (see get_data_2)
+    # queue_size: downloaded files waiting to be processed per category; the downloads wait when it is full
+    # max_workers, retries, backoff, timeout: see get_data_2
+    # workers   : see make_epw_batch
+    # url_files, data_dir: see get_data_2
+    # processed_dir, output_folder, years, timezone, scaling_factor: see make_epw_batch
+    # Only the 'npy' store is written, export CSV files afterwards with read_NC4_3 if needed.
+
+    start = time.perf_counter()
+    processed_dir = base_output_folder if processed_dir is None else processed_dir
+    grid = merra2_grid([merra2_index(latitude, longitude) for _, latitude, longitude in sites]) if subset else None
+    queues = {}
+    consumers = []
+    ingested = []
+    failed = []
+    for category in MAX_WORKERS:
+        queues[category] = queue.Queue(maxsize=queue_size)
+        consumer = threading.Thread(target=_ingest_worker, name=f'ingest-{category}',
+                                    args=(queues[category], os.path.join(processed_dir, category), ingested, failed, grid))
+        consumer.start()
+        consumers.append(consumer)
+
+    # Hand every complete download to the consumer of its category
+    def on_complete(file_path):
+        queues[os.path.basename(os.path.dirname(file_path))].put(file_path)
+
+    try:
+        failed_downloads = get_data_2(max_workers, retries, backoff, timeout, on_complete, sites if subset else None, url_files,
+                                      data_dir)
+    finally:
+        for file_queue in queues.values():
+            file_queue.put(None)
+        for consumer in consumers:
+            consumer.join()
+
+    print(f"Processed {len(ingested)} files in {time.perf_counter() - start:.1f} s")
+
+    # All hours of the sites are in the store only when every file has been downloaded and processed
+    if failed_downloads or failed:
+        print(f"{len(failed_downloads)} downloads and {len(failed)} files failed, no EPW files were made. Run the pipeline again.")
+    elif sites is not None:
+        make_epw_batch(sites, workers=workers, output_folder=output_folder, years=years, timezone=timezone,
+                       processed_dir=processed_dir, scaling_factor=scaling_factor)
+
+# Add the new NC4 files to the store and remake only the EPW files whose period contains new hours
+@stage('update')
+def run_update(folders=None, workers=None, output_folder='2_Weather_File/EPW/', data_dir=None, processed_dir=None):
+
+    # folders      : category folders of the NC4 files (None = the folders in data_dir)
+    # data_dir     : folder of the downloaded files (None = base_dir)
+    # processed_dir: folder of the processed data (None = base_output_folder)
+
+    start = time.perf_counter()
+    updated = read_NC4_3(data_folders(data_dir) if folders is None else folders, workers=workers, processed_dir=processed_dir)
+    if not updated:
+        print("No new data, all EPW files are up to date.")
+        return
+
+    # Only the files whose own period contains new hours, grouped by their options. Entries of older manifests
+    # are one per site, for all its years.
+    sites = {}
+    for name, entry in _read_epw_manifest(output_folder).items():
+        if any(entry['start'] <= last and first <= entry['end'] for first, last in updated.values()):
+            years = entry.get('years', [2023])
+            combined = entry.get('combined', False)
+            options = (entry['store_format'], entry['interpolate'], tuple(years), entry.get('timezone', 'Asia/Shanghai'), combined,
+                       entry.get('leap_day', True), entry.get('per_year', not combined and len(years) > 1), entry.get('scaling_factor'))
+            sites.setdefault(options, []).append((entry.get('site', name), entry['latitude'], entry['longitude']))
+
+    for (store_format, interpolate, years, timezone, combined, leap_day, per_year, scaling_factor), group in sites.items():
+        make_epw_batch(group, store_format, workers, output_folder, interpolate, years=years, timezone=timezone,
+                       combined=combined, leap_day=leap_day, processed_dir=processed_dir, scaling_factor=scaling_factor,
+                       per_year=per_year)
+    print(f"Updated {sum(len(group) for group in sites.values())} EPW files in {time.perf_counter() - start:.1f} s")
 
 
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+### 6. Command line ###
+# python Merra2_to_EPW.py [command] [options]. Without a command the whole run: authorize, download, process and EPW.
+# Importing the module runs nothing and creates no folders, so the stages can also be called from other programs,
+# and jobs for different sites can run at the same time (EPW files, the manifest and the caches are written atomically).
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-get_authorize_1()
-get_data_2()
-read_NC4_3(folder_list)
-make_epw_4()
+COMMANDS = ['run', 'authorize', 'download', 'process', 'epw', 'tmy', 'pipeline', 'update']
+
+# Local years from 'YYYY' or 'YYYY-YYYY' values, e.g. ['1991-2020'] -> 1991, ..., 2020
+def _parse_years(values):
+    years = []
+    for value in values:
+        first, _, last = str(value).partition('-')
+        years.extend(range(int(first), int(last or first) + 1))
+    return years
+
+# Time zone as an IANA name or the UTC offset in hours
+def _parse_timezone(value):
+    try:
+        return int(value) if float(value) == int(float(value)) else float(value)
+    except ValueError:
+        return value
+
+# Sites of a CSV file with the columns name, latitude, longitude (a header line is skipped)
+def read_sites(path):
+    sites = []
+    with open(path, 'r') as file:
+        for line in file:
+            fields = [field.strip() for field in line.split(',')]
+            if len(fields) < 3:
+                continue
+            try:
+                sites.append((fields[0], float(fields[1]), float(fields[2])))
+            except ValueError:
+                continue  # Header
+    return sites
+
+def _command_parser():
+    parser = argparse.ArgumentParser(description="Generate EPW weather files from MERRA-2 data")
+    subparsers = parser.add_subparsers(dest='command')
+
+    # Options of all commands. They can also be given as {"option_name": value} in the --config file, the command line
+    # overrides it. The defaults are the constants of the module.
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--config', help="JSON file with the options, e.g. {\"data_dir\": \"...\", \"years\": [\"1991-2020\"]}")
+    options.add_argument('--url-file', nargs=2, action='append', metavar=('CATEGORY', 'PATH'),
+                         help="links list of a category (Wind, Solar, Snow, Precipitation), default URL_FILES")
+    options.add_argument('--data-dir', help=f"downloaded NC4 files (default {base_dir})")
+    options.add_argument('--processed-dir', help=f"processed data (default {base_output_folder})")
+    options.add_argument('--output-dir', help="EPW files (default 2_Weather_File/EPW/)")
+    options.add_argument('--solar-cache-dir', help=f"solar position cache (default {SOLAR_CACHE_FOLDER})")
+    options.add_argument('--site', nargs=3, action='append', metavar=('NAME', 'LAT', 'LON'))
+    options.add_argument('--sites-file', help="CSV file of name,latitude,longitude")
+    options.add_argument('--all', action='store_true', default=None, help="one EPW per MERRA-2 cell")
+    options.add_argument('--years', nargs='+', help="local years, e.g. 2023 or 1991-2020 (default EPW_YEARS)")
+    options.add_argument('--timezone', help="IANA name or UTC offset in hours (default EPW_TIMEZONE)")
+    options.add_argument('--scaling-factor', type=float, help=f"factor of the radiation (default {SCALING_FACTOR})")
+    options.add_argument('--combined', action='store_true', default=None, help="one multi-year EPW per site")
+    options.add_argument('--no-leap-day', action='store_true', default=None, help="drop February 29")
+    options.add_argument('--interpolate', action='store_true', default=None, help="inverse distance weighting of the 4 closest cells")
+    options.add_argument('--store-format', choices=['npy', 'csv'])
+    options.add_argument('--csv', action='store_true', default=None, help="process: also export the lat_X_lon_Y.csv files")
+    options.add_argument('--subset', action='store_true', default=None, help="download only the cells of the sites")
+    options.add_argument('--method', choices=list(TMY_INDICES), help="TMY selection (default sandia)")
+    options.add_argument('--workers', type=int, help="processes for the EPW files and the CSV export")
+    options.add_argument('--username', help="NASA Earthdata login, asked for when ~/.netrc has none")
+    options.add_argument('--stats-file', help="append the run statistics as JSON lines")
+    options.add_argument('--profile', choices=['cprofile', 'py-spy'])
+
+    helps = {'run': "authorize, download, process and make the EPW files (default)",
+             'authorize': "write the NASA Earthdata login files", 'download': "download the NC4 files of the links lists",
+             'process': "add the downloaded files to the processed store", 'epw': "make the EPW files of the sites",
+             'tmy': "make typical meteorological years of the sites", 'pipeline': "download, process and make the EPW files at the same time",
+             'update': "add new NC4 files and remake the EPW files that cover them"}
+    for command in COMMANDS:
+        subparsers.add_parser(command, parents=[options], help=helps[command])
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['run'] + argv
+    args = _command_parser().parse_args(argv)
+
+    # Options of the config file that are not on the command line
+    if args.config:
+        with open(args.config, 'r') as file:
+            config = json.load(file)
+        for key, value in config.items():
+            key = key.replace('-', '_')
+            if not hasattr(args, key):
+                raise ValueError(f"Unknown option {key} in {args.config}")
+            if getattr(args, key) is None:
+                setattr(args, key, value)
+
+    # Settings of this process
+    global STATS_FILE, PROFILE, SOLAR_CACHE_FOLDER
+    STATS_FILE = args.stats_file or STATS_FILE
+    PROFILE = args.profile or PROFILE
+    SOLAR_CACHE_FOLDER = args.solar_cache_dir or SOLAR_CACHE_FOLDER
+
+    url_files = dict(URL_FILES, **dict(args.url_file)) if args.url_file else None
+    output_folder = args.output_dir or '2_Weather_File/EPW/'
+    sites = [(name, float(latitude), float(longitude)) for name, latitude, longitude in args.site or []]
+    if args.sites_file:
+        sites += read_sites(args.sites_file)
+    if args.all:
+        sites = 'all'
+    epw_options = dict(store_format=args.store_format or 'npy', workers=args.workers, output_folder=output_folder,
+                       interpolate=bool(args.interpolate), years=_parse_years(args.years) if args.years else None,
+                       timezone=None if args.timezone is None else _parse_timezone(args.timezone),
+                       processed_dir=args.processed_dir, scaling_factor=args.scaling_factor)
+    if args.command in ('epw', 'tmy') and not sites:
+        raise SystemExit(f"{args.command}: give the sites with --site, --sites-file or --all")
+    if args.subset and (sites == 'all' or not sites):
+        raise SystemExit("--subset needs the sites as --site or --sites-file")
+
+    if args.command in ('run', 'authorize', 'download', 'pipeline'):
+        get_authorize_1(args.username)
+    if args.command in ('run', 'download'):
+        get_data_2(sites=sites if args.subset else None, url_files=url_files, data_dir=args.data_dir)
+    if args.command in ('run', 'process'):
+        read_NC4_3(data_folders(args.data_dir), workers=args.workers, formats=('npy', 'csv') if args.csv else ('npy',),
+                   processed_dir=args.processed_dir)
+    if args.command == 'run':
+        if sites:
+            make_epw_batch(sites, combined=bool(args.combined), leap_day=not args.no_leap_day, **epw_options)
+        else:
+            epw_options.pop('workers')
+            make_epw_4(combined=bool(args.combined), leap_day=not args.no_leap_day, **epw_options)
+    elif args.command == 'epw':
+        make_epw_batch(sites, combined=bool(args.combined), leap_day=not args.no_leap_day, **epw_options)
+    elif args.command == 'tmy':
+        make_tmy_batch(sites, method=args.method or 'sandia', **epw_options)
+    elif args.command == 'pipeline':
+        run_pipeline(sites or None, workers=args.workers, subset=bool(args.subset), url_files=url_files, data_dir=args.data_dir,
+                     processed_dir=args.processed_dir, output_folder=output_folder, years=epw_options['years'],
+                     timezone=epw_options['timezone'], scaling_factor=args.scaling_factor)
+    elif args.command == 'update':
+        run_update(workers=args.workers, output_folder=output_folder, data_dir=args.data_dir, processed_dir=args.processed_dir)
+    if args.command != 'authorize':
+        stats_summary()
+
+if __name__ == "__main__":
+    main()
 
 
 
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import contextlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+### Benchmarks for Merra2_to_EPW.py ###
+# Runs offline on synthetic data, e.g.:
+#   python benchmark.py split --cells 1 10 100 1000 2000 --hours 744
+#   python benchmark.py suite --region 34 37 117 121 --years 2 --output after.json --baseline before.json
+#   python benchmark.py fixtures --region 34 37 117 121 --years 1 --workdir bench
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Synthetic (time, lat, lon) block on the MERRA-2 0.5° x 0.625° grid with the Wind variables
+def synthetic_block(n_cells, hours):
+    n_lat = int(np.ceil(np.sqrt(n_cells)))
+    n_lon = int(np.ceil(n_cells / n_lat))
+    lats = 30.0 + 0.5 * np.arange(n_lat)
+    lons = 110.0 + 0.625 * np.arange(n_lon)
+    times = pd.date_range('2023-01-01 00:30:00', periods=hours, freq='h')
+    rng = np.random.default_rng(0)
+    variables = {var: (('time', 'lat', 'lon'), rng.random((hours, n_lat, n_lon), dtype='float32'))
+                 for var in ['PS', 'QV2M', 'T2M', 'T2MDEW', 'U2M', 'V2M']}
+    return xr.Dataset(variables, coords={'time': times, 'lat': lats, 'lon': lons})
+
+# The per-cell split read_NC4_3 used before: one boolean mask over the long-format table per cell
+def split_by_mask(block, output_folder):
+    df = block.to_dataframe().reset_index()
+    unique_locs = df[['lat', 'lon']].drop_duplicates()
+    for _, loc in unique_locs.iterrows():
+        lat = loc['lat']
+        lon = loc['lon']
+        df_loc = df[(df['lat'] == lat) & (df['lon'] == lon)]
+        df_loc.to_csv(f'{output_folder}/lat_{lat}_lon_{lon}.csv', index=False)
+
+def bench_split(args):
+    import Merra2_to_EPW
+
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+
+    print(f"{'cells':>8} {'method':>8} {'seconds':>10} {'ms/cell':>10}")
+    for n_cells in args.cells:
+        block = synthetic_block(n_cells, args.hours)
+        n_cells = block.sizes['lat'] * block.sizes['lon']
+        methods = [('array', lambda folder: Merra2_to_EPW.write_block_csv(block, folder, executor=executor))]
+        if n_cells <= args.mask_limit:
+            methods.append(('mask', lambda folder: split_by_mask(block, folder)))
+
+        for name, run in methods:
+            with tempfile.TemporaryDirectory() as folder:
+                start = time.perf_counter()
+                run(folder)
+                seconds = time.perf_counter() - start
+            print(f"{n_cells:>8} {name:>8} {seconds:>10.3f} {1000 * seconds / n_cells:>10.2f}")
+
+    if executor is not None:
+        executor.shutdown()
+
+# Collections of the MERRA-2 files with the variables the script reads, under their category folders
+COLLECTIONS = {
+    'Wind': ('tavg1_2d_slv_Nx', ['PS', 'QV2M', 'T2M', 'T2MDEW', 'U2M', 'V2M']),
+    'Solar': ('tavg1_2d_rad_Nx', ['CLDTOT', 'SWGDN']),
+    'Snow': ('tavg1_2d_lnd_Nx', ['SNODP']),
+    'Precipitation': ('tavg1_2d_flx_Nx', ['PRECTOT']),
+}
+UNITS = {'PS': 'Pa', 'QV2M': 'kg kg-1', 'T2M': 'K', 'T2MDEW': 'K', 'U2M': 'm s-1', 'V2M': 'm s-1', 'CLDTOT': '1',
+         'SWGDN': 'W m-2', 'SNODP': 'm', 'PRECTOT': 'kg m-2 s-1'}
+STEPS = ['ingest', 'split', 'lookup', 'epw', 'tmy']
+
+# MERRA-2 file stream of a year (the number in MERRA2_400.tavg1_2d_slv_Nx.20230101.nc4)
+def merra2_stream(year):
+    return 100 if year < 1992 else 200 if year < 2001 else 300 if year < 2011 else 400
+
+# Cells of the MERRA-2 grid (0.5 x 0.625 degrees) inside a lat/lon box
+def region_grid(lat_min, lat_max, lon_min, lon_max):
+    import Merra2_to_EPW
+    (i0, j0), (i1, j1) = Merra2_to_EPW.merra2_index(lat_min, lon_min), Merra2_to_EPW.merra2_index(lat_max, lon_max)
+    return Merra2_to_EPW.merra2_grid([(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)])
+
+# One day of the four collections on the grid: seasonal and diurnal cycles, a clear-sky sun with clouds, winter snow
+# and showers. The random numbers are seeded by the day, so the files do not depend on the order they are written in.
+def synthetic_day(day, lats, lons, seed=0):
+    rng = np.random.default_rng([seed, day.toordinal()])
+    times = pd.date_range(day, periods=24, freq='h') + pd.Timedelta(minutes=30)
+    shape = (24, len(lats), len(lons))
+    lat = np.asarray(lats)[None, :, None]
+    lon = np.asarray(lons)[None, None, :]
+    day_of_year = day.dayofyear
+    local_hour = (times.hour.to_numpy()[:, None, None] + 0.5 + lon / 15) % 24
+    season = -np.cos(2 * np.pi * (day_of_year - 15) / 365.25) * np.sign(lat + 1e-9)
+
+    declination = np.radians(23.44) * np.sin(2 * np.pi * (284 + day_of_year) / 365)
+    cos_zenith = (np.sin(np.radians(lat)) * np.sin(declination) +
+                  np.cos(np.radians(lat)) * np.cos(declination) * np.cos(np.radians(15 * (local_hour - 12))))
+    cloud = np.clip(rng.beta(2, 2, shape[1:])[None] + 0.1 * rng.standard_normal(shape), 0, 1)
+
+    t2m = 288 - 0.4 * (np.abs(lat) - 35) + 12 * season + 4 * np.cos(2 * np.pi * (local_hour - 15) / 24) + 1.5 * rng.standard_normal(shape)
+    dew = t2m - 4 - 3 * rng.random(shape)
+    ps = 100500 + 300 * rng.standard_normal(shape)
+    e = 611.2 * np.exp(17.67 * (dew - 273.15) / (dew - 29.65))
+    values = {
+        'PS': ps, 'QV2M': 0.622 * e / (ps - 0.378 * e), 'T2M': t2m, 'T2MDEW': dew,
+        'U2M': 3 * rng.standard_normal(shape), 'V2M': 3 * rng.standard_normal(shape),
+        'CLDTOT': cloud, 'SWGDN': 1100 * np.clip(cos_zenith, 0, None) * (1 - 0.6 * cloud),
+        'SNODP': np.clip(-0.2 * season, 0, None) * (t2m < 275) * np.ones(shape),
+        'PRECTOT': rng.exponential(2e-4, shape) * (rng.random(shape) < 0.08),
+    }
+    coords = {'time': times, 'lat': np.asarray(lats, dtype='float64'), 'lon': np.asarray(lons, dtype='float64')}
+    return {category: xr.Dataset({var: (('time', 'lat', 'lon'), values[var].astype('float32'), {'units': UNITS[var]}) for var in variables},
+                                 coords=coords)
+            for category, (_, variables) in COLLECTIONS.items()}
+
+# Write the .nc4 files of one day into <data_dir>/<Category>/, named and encoded like the MERRA-2 files
+def write_synthetic_day(data_dir, day, lats, lons, seed=0, compress=True):
+    day = pd.Timestamp(day)
+    for category, ds in synthetic_day(day, lats, lons, seed).items():
+        collection, variables = COLLECTIONS[category]
+        path = os.path.join(data_dir, category, f'MERRA2_{merra2_stream(day.year)}.{collection}.{day:%Y%m%d}.nc4')
+        encoding = {var: {'zlib': compress, 'complevel': 2, 'dtype': 'float32'} for var in variables}
+        encoding['time'] = {'units': f'minutes since {day:%Y-%m-%d} 00:30:00', 'dtype': 'int32'}
+        ds.to_netcdf(path, encoding=encoding, format='NETCDF4')
+
+# Synthetic MERRA-2 downloads for the region and years, one file per collection and day (skips days already written)
+def make_fixtures(data_dir, region, first_year, years, seed=0, workers=1, compress=True):
+    grid = region_grid(*region)
+    days = pd.date_range(f'{first_year}-01-01', f'{first_year + years - 1}-12-31', freq='D')
+    for category in COLLECTIONS:
+        os.makedirs(os.path.join(data_dir, category), exist_ok=True)
+    last = os.path.join(data_dir, 'Precipitation', f"MERRA2_{merra2_stream(days[-1].year)}.{COLLECTIONS['Precipitation'][0]}.{days[-1]:%Y%m%d}.nc4")
+    if os.path.exists(last):
+        return grid
+
+    start = time.perf_counter()
+    args = [(data_dir, day, grid['lat'], grid['lon'], seed, compress) for day in days]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(write_synthetic_day, *zip(*args), chunksize=16))
+    else:
+        for arg in args:
+            write_synthetic_day(*arg)
+    print(f"Wrote {len(days) * len(COLLECTIONS)} files of {len(grid['lat'])} x {len(grid['lon'])} cells in {time.perf_counter() - start:.1f} s")
+    return grid
+
+# Run one step of the suite in this (fresh) process and return its stage records, so the peak RSS is that of the step
+def run_step(step, years, workers, lookups, seed, verbose):
+    import Merra2_to_EPW
+    folders = [os.path.join(Merra2_to_EPW.base_dir, category) for category in COLLECTIONS]
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with output:
+        if step == 'ingest':
+            Merra2_to_EPW.read_NC4_3(folders, workers=workers, incremental=False)
+        elif step == 'split':
+            Merra2_to_EPW.read_NC4_3(folders, workers=workers, formats=('csv',))
+        elif step == 'lookup':
+            grid = Merra2_to_EPW.open_grid(os.path.join(Merra2_to_EPW.base_output_folder, 'Solar'))
+            rng = np.random.default_rng(seed)
+            points = np.column_stack([rng.uniform(grid['lat'][0], grid['lat'][-1], lookups), rng.uniform(grid['lon'][0], grid['lon'][-1], lookups)])
+            with Merra2_to_EPW.stage('lookup'):
+                for latitude, longitude in points:
+                    Merra2_to_EPW.nearest_cell(grid, latitude, longitude)
+                Merra2_to_EPW.stage_counts(sites=lookups, cells=len(grid['lat']) * len(grid['lon']))
+            with Merra2_to_EPW.stage('idw'):
+                for latitude, longitude in points[:lookups // 10]:
+                    Merra2_to_EPW.idw_cells(grid, latitude, longitude)
+                Merra2_to_EPW.stage_counts(sites=lookups // 10, cells=len(grid['lat']) * len(grid['lon']))
+        elif step == 'epw':
+            Merra2_to_EPW.make_epw_batch('all', workers=workers, years=years, timezone=0)
+        elif step == 'tmy':
+            Merra2_to_EPW.make_tmy_batch('all', years=years, timezone=0, workers=workers)
+    return [record for record in Merra2_to_EPW._stats if record['kind'] == 'stage']
+
+def bench_suite(args):
+    region = tuple(args.region)
+    years = list(range(args.first_year, args.first_year + args.years))
+    steps = [step for step in STEPS if step in args.steps]
+    import Merra2_to_EPW
+    grid = make_fixtures(Merra2_to_EPW.base_dir, region, args.first_year, args.years, args.seed, args.workers, not args.no_compress)
+    n_cells = len(grid['lat']) * len(grid['lon'])
+
+    rows = []
+    for step in steps:
+        # A fresh process per step, so each peak RSS is the step's own
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            records = executor.submit(run_step, step, years, args.workers, args.lookups, args.seed, args.verbose).result()
+        for record in records:
+            rows.append(dict(step=step, **{key: value for key, value in record.items() if key not in ('kind', 'time', 'profile')}))
+
+    results = {
+        'config': {'region': region, 'cells': n_cells, 'first_year': args.first_year, 'years': args.years,
+                   'workers': args.workers, 'lookups': args.lookups, 'seed': args.seed, 'compress': not args.no_compress},
+        'versions': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                     'xarray': xr.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'results': rows,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        if baseline['config'] != json.loads(json.dumps(results['config'])):
+            print(f"Warning: {args.baseline} was run with a different configuration: {baseline['config']}")
+        baseline = {(row['step'], row['stage']): row for row in baseline['results']}
+
+    print(f"{n_cells} cells, {args.years} years, {args.workers} workers")
+    print(f"{'step':<8} {'stage':<8} {'seconds':>9} {'files/s':>9} {'cells/s':>9} {'sites/s':>10} {'MB/s':>7} {'RSS MB':>8} {'pool MB':>8}"
+          + (f" {'vs base':>8}" if baseline else ''))
+    for row in rows:
+        rate = lambda key: f"{row[key]:.1f}" if key in row else '-'
+        line = (f"{row['step']:<8} {row['stage']:<8} {row['seconds']:>9.2f} {rate('files_per_s'):>9} {rate('cells_per_s'):>9} "
+                f"{rate('sites_per_s'):>10} {row['MB_per_s']:>7.2f} {row['peak_rss_mb'] or 0:>8.0f} {row['peak_rss_children_mb'] or 0:>8.0f}")
+        if baseline:
+            base = baseline.get((row['step'], row['stage']))
+            line += f" {row['seconds'] / base['seconds']:>7.2f}x" if base else f" {'-':>8}"
+        print(line)
+
+    if args.output:
+        with open(os.path.join(args.cwd, args.output), 'w') as file:
+            json.dump(results, file, indent=1)
+        print(f"Saved the results to {args.output}")
+
+def bench_fixtures(args):
+    import Merra2_to_EPW
+    grid = make_fixtures(Merra2_to_EPW.base_dir, tuple(args.region), args.first_year, args.years, args.seed, args.workers, not args.no_compress)
+    print(f"{len(grid['lat']) * len(grid['lon'])} cells in {os.path.abspath(Merra2_to_EPW.base_dir)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for Merra2_to_EPW.py")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    split = subparsers.add_parser('split', help="per-cell split of one time block (read_NC4_3)")
+    split.add_argument('--cells', type=int, nargs='+', default=[1, 10, 100, 1000, 2000])
+    split.add_argument('--hours', type=int, default=744)
+    split.add_argument('--workers', type=int, default=os.cpu_count())
+    split.add_argument('--mask-limit', type=int, default=400, help="largest region timed with the old mask split")
+    split.set_defaults(run=bench_split)
+
+    # Options of the synthetic MERRA-2 downloads
+    fixture_options = argparse.ArgumentParser(add_help=False)
+    fixture_options.add_argument('--region', type=float, nargs=4, default=[34.0, 37.0, 117.0, 121.0],
+                                 metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'))
+    fixture_options.add_argument('--first-year', type=int, default=2023)
+    fixture_options.add_argument('--years', type=int, default=1)
+    fixture_options.add_argument('--seed', type=int, default=0)
+    fixture_options.add_argument('--workers', type=int, default=os.cpu_count())
+    fixture_options.add_argument('--no-compress', action='store_true', help="write the .nc4 files without zlib")
+    fixture_options.add_argument('--workdir', help="keep the fixtures (and the processed data) in this folder and reuse them")
+
+    suite = subparsers.add_parser('suite', parents=[fixture_options], help="ingest, split, nearest-cell lookup and EPW/TMY on synthetic MERRA-2 files")
+    suite.add_argument('--steps', nargs='+', choices=STEPS, default=['ingest', 'split', 'lookup', 'epw'])
+    suite.add_argument('--lookups', type=int, default=100000, help="sites looked up in the nearest-cell step")
+    suite.add_argument('--output', help="save the results as JSON, to compare later runs against")
+    suite.add_argument('--baseline', help="results of an earlier run, the times are shown relative to it")
+    suite.add_argument('--verbose', action='store_true', help="show the output of Merra2_to_EPW")
+    suite.set_defaults(run=bench_suite)
+
+    fixtures = subparsers.add_parser('fixtures', parents=[fixture_options], help="only write the synthetic MERRA-2 files")
+    fixtures.set_defaults(run=bench_fixtures)
+
+    args = parser.parse_args()
+    args.cwd = os.getcwd()
+    if getattr(args, 'baseline', None):
+        args.baseline = os.path.abspath(args.baseline)
+
+    # The default folders of Merra2_to_EPW are relative to the working directory, keep them out of the repo
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if getattr(args, 'workdir', None):
+        os.makedirs(args.workdir, exist_ok=True)
+        os.chdir(args.workdir)
+        args.run(args)
+        return
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import http.server
+import os
+import re
+import threading
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import Merra2_to_EPW
+
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+# Local HTTP stand-in for the GES DISC server: Range requests, failing and truncated responses, and OPeNDAP subsets
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def _body(name):
+    return (name * 5000).encode()
+
+# netCDF file of an OPeNDAP constraint (VAR[t0:t1][i0:i1][j0:j1],...,lat[i0:i1],lon[j0:j1],time[t0:t1]) for the day in the
+# file name. Every variable holds i * 1000 + j of its cell, so the cells can be told apart in the store.
+def _opendap_body(name, query):
+    day = re.search(r'\.(\d{8})\.nc4', name).group(1)
+    slices = {var: [tuple(map(int, index.split(':'))) for index in re.findall(r'\[([^\]]+)\]', ranges)]
+              for var, ranges in re.findall(r'(\w+)((?:\[[^\]]+\])+)', unquote(query))}
+    (i0, i1), (j0, j1), (t0, t1) = slices['lat'][0], slices['lon'][0], slices['time'][0]
+    rows, cols = np.arange(i0, i1 + 1), np.arange(j0, j1 + 1)
+    times = pd.date_range(day, periods=24, freq='h')[t0:t1 + 1] + pd.Timedelta(minutes=30)
+    cells = np.broadcast_to(rows[:, None] * 1000 + cols[None, :], (len(times), len(rows), len(cols))).astype('float32')
+    data_vars = {var: (('time', 'lat', 'lon'), cells) for var in slices if var not in ('lat', 'lon', 'time')}
+    coords = dict(time=times, lat=-90 + 0.5 * rows, lon=-180 + 0.625 * cols)
+    return bytes(xr.Dataset(data_vars, coords=coords).to_netcdf())
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        name = self.path.split('/')[-1].split('?')[0]
+        with self.server.lock:
+            self.server.hits[name] = self.server.hits.get(name, 0) + 1
+            self.server.ranges.setdefault(name, []).append(self.headers.get('Range'))
+            hits = self.server.hits[name]
+        body = _body(name)
+
+        if '?' in self.path:
+            query = self.path.split('?', 1)[1]
+            with self.server.lock:
+                self.server.queries.append(query)
+            body = _opendap_body(name, query)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # flaky*: two server errors before the file is sent
+        if name.startswith('flaky') and hits < 3:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        # missing*: not on the server, and busy*: too many requests the first time
+        if name.startswith('missing') or (name.startswith('busy') and hits < 2):
+            self.send_response(404 if name.startswith('missing') else 429)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        # trunc*: the first response is cut off after 1000 bytes
+        if name.startswith('trunc') and hits < 2:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:1000])
+            self.close_connection = True
+            return
+
+        start = int(self.headers['Range'].split('=')[1].rstrip('-')) if self.headers.get('Range') else None
+        if start is not None and start >= len(body):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(body)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if start is not None:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.hits, server.ranges, server.queries, server.lock = {}, {}, [], threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _url(server, name):
+    return f'http://127.0.0.1:{server.server_port}/{name}'
+
+def _download(server, names, target_dir):
+    return Merra2_to_EPW.download_files([_url(server, name) for name in names], str(target_dir), max_workers=2, retries=3,
+                                        backoff=0, timeout=(5, 5))
+
+
+def test_flaky_and_truncated_downloads_are_retried(server, tmp_path):
+    assert _download(server, ['flaky.nc4', 'trunc.nc4'], tmp_path) == []
+    for name in ['flaky.nc4', 'trunc.nc4']:
+        assert (tmp_path / name).read_bytes() == _body(name)
+        assert not (tmp_path / (name + '.part')).exists()
+    assert server.hits['flaky.nc4'] == 3
+    assert server.hits['trunc.nc4'] == 2
+
+def test_permanent_errors_are_not_retried(server, tmp_path):
+    assert _download(server, ['missing.nc4', 'busy.nc4'], tmp_path) == [_url(server, 'missing.nc4')]
+    assert server.hits['missing.nc4'] == 1
+    assert not (tmp_path / 'missing.nc4').exists()
+    assert server.hits['busy.nc4'] == 2
+    assert (tmp_path / 'busy.nc4').read_bytes() == _body('busy.nc4')
+
+def test_partial_file_is_resumed(server, tmp_path):
+    (tmp_path / 'resume.nc4.part').write_bytes(_body('resume.nc4')[:1234])
+    assert _download(server, ['resume.nc4'], tmp_path) == []
+    assert (tmp_path / 'resume.nc4').read_bytes() == _body('resume.nc4')
+    assert server.ranges['resume.nc4'] == ['bytes=1234-']
+
+def test_complete_part_file_is_renamed(server, tmp_path):
+    # A run stopped after the last chunk but before the rename: the server answers 416 to the Range request
+    (tmp_path / 'done.nc4.part').write_bytes(_body('done.nc4'))
+    assert _download(server, ['done.nc4'], tmp_path) == []
+    assert (tmp_path / 'done.nc4').read_bytes() == _body('done.nc4')
+    assert not (tmp_path / 'done.nc4.part').exists()
+    assert server.hits['done.nc4'] == 1
+
+def test_oversized_part_file_is_downloaded_again(server, tmp_path):
+    (tmp_path / 'long.nc4.part').write_bytes(_body('long.nc4') + b'garbage')
+    assert _download(server, ['long.nc4'], tmp_path) == []
+    assert (tmp_path / 'long.nc4').read_bytes() == _body('long.nc4')
+    assert server.ranges['long.nc4'] == [f"bytes={len(_body('long.nc4')) + 7}-", None]
+
+def test_downloaded_files_are_skipped(server, tmp_path):
+    assert _download(server, ['once.nc4'], tmp_path) == []
+    assert _download(server, ['once.nc4'], tmp_path) == []
+    assert server.hits['once.nc4'] == 1
+
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+# Downloads of the cells of the sites only (get_data_2 with sites) and their store
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+COLLECTIONS = {'Wind': 'slv', 'Solar': 'rad', 'Snow': 'lnd', 'Precipitation': 'flx'}
+SITES = [('A', 35.4, 119.3), ('B', 36.6, 120.7)]  # Cells (251, 479) and (253, 481)
+
+# Links list of one day of a collection as the GES DISC writes it: a region of 11 x 13 cells, brackets percent-encoded
+def _links_list(server, collection, path):
+    name = f'MERRA2_400.tavg1_2d_{COLLECTIONS[collection]}_Nx.20230101.nc4.nc4'
+    query = ','.join(f'{var}%5B0:23%5D%5B250:260%5D%5B478:490%5D' for var in Merra2_to_EPW.REQUIRED_VARIABLES[collection])
+    with open(path, 'w') as file:
+        file.write('README\n')
+        file.write(f'{_url(server, name)}?{query},lat%5B250:260%5D,lon%5B478:490%5D,time%5B0:23%5D\n')
+
+def test_subset_url_requests_one_cell():
+    url = ('https://goldsmr4.gesdisc.eosdis.nasa.gov/opendap/MERRA2/M2T1NXSLV.5.12.4/2023/01/MERRA2_400.tavg1_2d_slv_Nx.20230101.nc4.nc4'
+           '?PS%5B0:23%5D%5B250:260%5D%5B478:490%5D,lat%5B250:260%5D,lon%5B478:490%5D,time%5B0:23%5D')
+    subset = Merra2_to_EPW.subset_url(url, 'Wind', 251, 479)
+    base, _, query = subset.partition('?')
+    query, _, cell = query.partition('#')
+    assert base == url.partition('?')[0]
+    assert cell == 'i251_j479'
+    assert '[' not in query and ']' not in query
+    assert query.split(',') == [f'{var}%5B0:23%5D%5B251:251%5D%5B479:479%5D' for var in Merra2_to_EPW.REQUIRED_VARIABLES['Wind']] + \
+        ['lat%5B251:251%5D', 'lon%5B479:479%5D', 'time%5B0:23%5D']
+    assert Merra2_to_EPW._download_filename(subset) == 'tavg1_2d_slv_Nx.20230101.i251_j479.nc4'
+
+def test_site_cells_are_downloaded_and_stored_in_one_grid(server, tmp_path):
+    url_files = {}
+    for collection in COLLECTIONS:
+        url_files[collection] = str(tmp_path / f'{collection}.txt')
+        _links_list(server, collection, url_files[collection])
+    data_dir, processed_dir = str(tmp_path / 'data'), str(tmp_path / 'processed')
+    failed = Merra2_to_EPW.get_data_2(max_workers={collection: 2 for collection in COLLECTIONS}, retries=0, backoff=0, sites=SITES,
+                                      url_files=url_files, data_dir=data_dir)
+    assert failed == []
+
+    # One request per collection and cell, with the variables of the collection and encoded brackets
+    assert len(server.queries) == 8
+    for query in server.queries:
+        assert '[' not in query and '%5B' in query
+        variables = {var for var, _ in re.findall(r'(\w+)((?:\[[^\]]+\])+)', unquote(query))} - {'lat', 'lon', 'time'}
+        assert variables in [set(names) for names in Merra2_to_EPW.REQUIRED_VARIABLES.values()]
+    for collection, short in COLLECTIONS.items():
+        files = sorted(f for f in os.listdir(os.path.join(data_dir, collection)) if f.endswith('.nc4'))
+        assert files == [f'tavg1_2d_{short}_Nx.20230101.i251_j479.nc4', f'tavg1_2d_{short}_Nx.20230101.i253_j481.nc4']
+        assert [Merra2_to_EPW._cell_tag(f) for f in files] == ['i251_j479', 'i253_j481']
+
+    # Both cells in the grid of every store, the cells between them are empty
+    Merra2_to_EPW.read_NC4_3(Merra2_to_EPW.data_folders(data_dir), workers=1, processed_dir=processed_dir)
+    for collection in COLLECTIONS:
+        output_folder = os.path.join(processed_dir, collection)
+        assert Merra2_to_EPW.open_grid(output_folder) == {'lat': [35.5, 36.5], 'lon': [119.375, 120.625]}
+        var = Merra2_to_EPW.REQUIRED_VARIABLES[collection][0]
+        for (i, j), expected in {(0, 0): 251479, (1, 1): 253481, (0, 1): None, (1, 0): None}.items():
+            values = Merra2_to_EPW.read_cell(output_folder, i, j, years=[2023])[var].to_numpy()[:24]
+            assert np.isnan(values).all() if expected is None else (values == expected).all(), (collection, i, j)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+import Merra2_to_EPW
+
+
+def _hour(stamp):
+    return np.datetime64(stamp, 'h').astype(np.int64)
+
+def test_epw_hours_of_a_leap_year_in_a_western_zone():
+    utc_hours, local_hours = Merra2_to_EPW._epw_hours([2024], 'America/New_York')
+    assert len(local_hours) == 8784
+    assert local_hours[0] == _hour('2024-01-01T00')
+    # Standard time all year (UTC-5), also in summer
+    assert (utc_hours - local_hours == 5).all()
+    assert _hour('2024-02-29T12') in local_hours
+
+def test_epw_hours_without_leap_day():
+    utc_hours, local_hours = Merra2_to_EPW._epw_hours([2023, 2024], 8, leap_day=False)
+    assert len(local_hours) == 2 * 8760
+    assert not np.isin(np.arange(_hour('2024-02-29T00'), _hour('2024-03-01T00')), local_hours).any()
+    assert (utc_hours == local_hours - 8).all()
+    # Feb 28 23:00 is followed by Mar 1 00:00
+    last_of_february = np.flatnonzero(local_hours == _hour('2024-02-28T23'))[0]
+    assert local_hours[last_of_february + 1] == _hour('2024-03-01T00')
+
+def test_hour_positions_of_gaps_and_repeated_hours():
+    times = np.array(['2024-02-28T22:30', '2024-02-28T23:30', '2024-02-29T02:30', '2024-02-29T02:30'], dtype='datetime64[m]')
+    hours = np.arange(_hour('2024-02-28T22'), _hour('2024-02-29T04'))
+    assert Merra2_to_EPW._hour_positions(times, hours).tolist() == [0, 1, -1, -1, 3, -1]
+
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+# _epw_table on a cell with a few days of data around February 29, 2024, with a 6 hour gap, in UTC-5
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def gap_cell():
+    times = pd.date_range('2024-02-27 00:30', '2024-03-02 23:30', freq='h')
+    gap = (times >= '2024-02-29 10:00') & (times < '2024-02-29 16:00')
+    times = times[~gap]
+    hour = np.arange(len(times), dtype='float64')
+    variables = {
+        'Wind': {'PS': 101325 + 0 * hour, 'QV2M': 0.004 + 0 * hour, 'T2M': 273.15 + hour / 10, 'T2MDEW': 268.15 + 0 * hour,
+                 'U2M': 1 + 0 * hour, 'V2M': 1 + 0 * hour},
+        'Solar': {'CLDTOT': 0.5 + 0 * hour, 'SWGDN': 300 + 0 * hour},
+        'Snow': {'SNODP': 0 * hour},
+        'Precipitation': {'PRECTOT': 0 * hour},
+    }
+    data = {category: pd.DataFrame(dict(time=times, lat=40.0, lon=-74.375, **columns)) for category, columns in variables.items()}
+    return data, times
+
+def test_epw_table_aligns_leap_day_zone_and_gap(tmp_path, monkeypatch):
+    # The solar position of the cell from the cache, as make_epw_batch does by default
+    monkeypatch.setattr(Merra2_to_EPW, 'SOLAR_CACHE_FOLDER', str(tmp_path))
+    data, times = gap_cell()
+    table, missing = Merra2_to_EPW._epw_table(data, 40.0, -74.4, solar_method='nrel_numpy', years=[2024], timezone=-5)
+    assert len(table['Year']) == 8784
+    assert missing == 8784 - len(times)
+
+    # Rows by local date and hour; EPW hour 1 is 00:00-01:00 local, the MERRA-2 hour at 05:30 UTC
+    rows = pd.DataFrame({'Month': table['Month'], 'Day': table['Day'], 'Hour': table['Hour'], 'T': table['Dry Bulb Temperature']})
+    row = rows.index[(rows['Month'] == 2) & (rows['Day'] == 29) & (rows['Hour'] == 1)][0]
+    position = np.flatnonzero(times == pd.Timestamp('2024-02-29 05:30'))[0]
+    assert np.isclose(table['Dry Bulb Temperature'][row], position / 10)
+
+    # The gap (10:30-15:30 UTC = 05:30-10:30 local) is missing in every measured field, DNI included
+    gap_rows = rows.index[(rows['Month'] == 2) & (rows['Day'] == 29) & (rows['Hour'] >= 6) & (rows['Hour'] <= 11)]
+    assert len(gap_rows) == 6
+    for field in ['Dry Bulb Temperature', 'Atmospheric Station Pressure', 'Global Horizontal Radiation', 'Direct Normal Radiation',
+                  'Diffuse Horizontal Radiation', 'Wind Speed', 'Snow Depth', 'Liquid Precipitation Depth']:
+        assert np.isnan(table[field][gap_rows]).all(), field
+    assert np.isfinite(table['Direct Normal Radiation'][gap_rows[-1] + 1])
+
+    # Hours before the data starts are missing too (January is not in the cell)
+    assert np.isnan(table['Direct Normal Radiation'][0])
+
+def test_epw_table_without_leap_day(tmp_path, monkeypatch):
+    monkeypatch.setattr(Merra2_to_EPW, 'SOLAR_CACHE_FOLDER', str(tmp_path))
+    data, _ = gap_cell()
+    table, _ = Merra2_to_EPW._epw_table(data, 40.0, -74.4, solar_method='nrel_numpy', years=[2024], timezone=-5, leap_day=False)
+    assert len(table['Year']) == 8760
+    assert not ((table['Month'] == 2) & (table['Day'] == 29)).any()
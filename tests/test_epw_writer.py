@@ -0,0 +1,65 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+import Merra2_to_EPW
+
+# EPW of the fixture cell written by _write_epw, compared byte for byte
+GOLDEN_EPW = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'fixture_cell.epw')
+SITE = ('Fixture', 35.4, 119.3)
+HOURS = 72  # Rows of the EPW that are checked, the fixture covers the first days of the year
+
+
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+# Synthetic MERRA-2 cell: smooth daily and weather cycles, hourly at :30 in UTC, as _load_cell returns it
+#+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+def fixture_cell():
+    times = pd.date_range('2022-12-31 00:30', '2023-01-05 23:30', freq='h')
+    hour = np.arange(len(times), dtype='float64')
+    day = np.sin(2 * np.pi * (hour - 6) / 24)
+    weather = np.sin(2 * np.pi * hour / 61)
+    variables = {
+        'Wind': {'PS': 101325 + 800 * weather, 'QV2M': 0.004 + 0.001 * day, 'T2M': 275.15 + 6 * day + 3 * weather,
+                 'T2MDEW': 268.15 + 2 * day + 2 * weather, 'U2M': 3 * np.cos(hour / 7), 'V2M': 2 * np.sin(hour / 5)},
+        'Solar': {'CLDTOT': 0.5 + 0.45 * weather, 'SWGDN': np.clip(600 * day, 0, None) * (1 - 0.4 * weather)},
+        'Snow': {'SNODP': np.clip(0.02 * weather, 0, None)},
+        'Precipitation': {'PRECTOT': np.clip(2e-4 * weather, 0, None)},
+    }
+    return {category: pd.DataFrame(dict(time=times, lat=35.5, lon=119.375, **{var: values.astype('float32') for var, values in columns.items()}))
+            for category, columns in variables.items()}
+
+def fixture_table():
+    epw_data, _ = Merra2_to_EPW._epw_table(fixture_cell(), SITE[1], SITE[2], solar_cache=False, solar_method='nrel_numpy',
+                                           years=[2023], timezone=8)
+    return {name: value if np.ndim(value) == 0 else np.asarray(value)[:HOURS] for name, value in epw_data.items()}
+
+def write_fixture_epw(path):
+    Merra2_to_EPW._write_epw(fixture_table(), path, Merra2_to_EPW._epw_header([2023], 8, True, SITE))
+
+
+def test_epw_matches_golden_file(tmp_path):
+    path = str(tmp_path / 'fixture_cell.epw')
+    write_fixture_epw(path)
+    with open(path, 'rb') as new, open(GOLDEN_EPW, 'rb') as golden:
+        assert new.read() == golden.read()
+
+def test_epw_fields_match_previous_csv_writer(tmp_path):
+    # The writer before the EPW serializer: a DataFrame of all fields written by to_csv
+    epw_data = fixture_table()
+    previous = pd.DataFrame({name: np.broadcast_to(epw_data[name], HOURS) for name, _, _ in Merra2_to_EPW.EPW_FIELDS})
+    previous = pd.read_csv(io.StringIO(previous.to_csv(index=False, header=False)), header=None)
+
+    path = str(tmp_path / 'fixture_cell.epw')
+    write_fixture_epw(path)
+    new = pd.read_csv(path, skiprows=8, header=None)
+
+    assert new.shape == previous.shape == (HOURS, len(Merra2_to_EPW.EPW_FIELDS))
+    for column, (name, decimals, _) in enumerate(Merra2_to_EPW.EPW_FIELDS):
+        if decimals is None:
+            assert (new[column] == previous[column]).all(), name
+        else:
+            difference = np.abs(new[column].to_numpy(float) - previous[column].to_numpy(float))
+            assert difference.max() <= 0.5 * 10.0 ** -decimals + 1e-9, name